@@ -0,0 +1,51 @@
+"""
+Bridge between the asyncio pipeline and synchronous callers.
+
+The async versions of get_ai_response / process_file_monitor are the real
+implementation. Flask routes call them through run_sync(), which runs the
+coroutine on one long-lived background event loop, so every LLM, vision
+and TTS call in the process shares that loop and its async clients.
+The Telegram bot awaits the coroutines directly on its own loop.
+"""
+import asyncio
+import contextvars
+import threading
+
+_loop = None
+_lock = threading.Lock()
+
+
+def get_loop():
+    """Returns the background loop, starting its thread on first use."""
+    global _loop
+    if _loop is None:
+        with _lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=loop.run_forever, name="aio-loop", daemon=True)
+                thread.start()
+                _loop = loop
+    return _loop
+
+
+async def _with_context(coro, context):
+    # A task gets a fresh copy of the loop thread's context; restore the caller's
+    for var, value in context.items():
+        var.set(value)
+    return await coro
+
+
+def run_sync(coro, timeout=None):
+    """
+    Runs a coroutine on the background loop and blocks for its result.
+    The coroutine sees the caller's context variables (e.g. the profiling trace).
+    """
+    loop = get_loop()
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        coro.close()
+        raise RuntimeError("run_sync() called from the background loop; await the coroutine instead")
+    return asyncio.run_coroutine_threadsafe(_with_context(coro, contextvars.copy_context()), loop).result(timeout)
@@ -1,24 +1,51 @@
 
-from flask import Flask, request, render_template, jsonify, url_for
+from flask import Flask, Response, request, render_template, jsonify, url_for, send_from_directory
 from twilio.rest import Client
 import os
-import google.generativeai as genai
 from dotenv import load_dotenv
 import database
-from gtts import gTTS
-import uuid
+import roster
+import retention
+import llm
+import cache
+import aio
+import scheduler
+import prompt
+import tts
+import campaign
+import upload_queue
+import profiling
+import contextvars
+import hashlib
+import collections
+import threading
+import json
+import time
+import asyncio
+import weakref
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout
+from xml.sax.saxutils import escape
 
 # Load env before anything else
 load_dotenv()
 
 app = Flask(__name__)
 database.init_db()
+llm.configure()
+# Hand each request thread's DB connection back to the pool when it finishes
+app.teardown_appcontext(database.release_connection)
+
+
+@app.before_request
+def profiling_mode():
+    """X-Profile: cprofile|sampling profiles this request's traces (see profiling.py)."""
+    profiling.request_mode(request.headers.get(profiling.PROFILE_HEADER))
 
 # Ensure static folder exists
 os.makedirs('static', exist_ok=True)
 
 
-from groq import Groq
+from groq import Groq, AsyncGroq
 
 def get_groq_client():
     api_key = os.getenv("GROQ_API_KEY")
@@ -27,21 +54,37 @@ def get_groq_client():
         return None
     return Groq(api_key=api_key)
 
+# AsyncGroq's HTTP pool belongs to the loop that first used it, so keep one per loop
+_async_groq_clients = weakref.WeakKeyDictionary()
+
+def get_async_groq_client():
+    api_key = os.getenv("GROQ_API_KEY")
+    if not api_key:
+        print("WARNING: GROQ_API_KEY not set.")
+        return None
+    loop = asyncio.get_running_loop()
+    client = _async_groq_clients.get(loop)
+    if client is None:
+        client = _async_groq_clients[loop] = AsyncGroq(api_key=api_key)
+    return client
+
 
 
 SYSTEM_PROMPT = """
 You are a helpful Malayalam AI tutor and Faculty Advisor for Class S8 ADS. 
 Respond in Malayalam. 
 
-DATA CONTEXT (Student Records):
+DATA CONTEXT (Caller's Student Record / Roster Index):
 {student_context}
 
 UPLOADED DOCUMENT CONTEXT (LATEST CIRCULAR/NEWS):
 {doc_context}
 
+Excerpts from earlier circulars relevant to the parent's question may be attached to their message under [CIRCULAR EXCERPTS]. Use them to answer; they are not something the parent said.
+
 
 INSTRUCTIONS:
-1. **ROLE**: You are the warm, knowledgeable Faculty Advisor. You know every student's details by heart.
+1. **ROLE**: You are the warm, knowledgeable Faculty Advisor. Once the parent is identified, their child's full record is given above.
 2. **TONE**: Speak in **NATURAL, SPOKEN MALAYALAM**. Avoid "bookish" or complex words. Use a respectful, warm tone suitable for talking to a parent on the phone. Keep sentences short and clear for the voice assistant to read easily.
 3. **PRIORITY 1: THE UPLOADED DOCUMENT**: If {doc_context} is not empty, you MUST mention this FIRST. "Sir/Madam, I just received this circular: [Summary of doc_context]."
 4. **PRIORITY 2: THE STUDENT**: 
@@ -57,6 +100,7 @@ FORMATTING: Do NOT use markdown. Plain text only.
 
 METADATA: At the end of EVERY response, append:
 [[META: ParentName|AttendanceStatus]]
+Use the parent's name exactly as written in the records (or Unknown if not identified yet).
 """
 
 
@@ -66,7 +110,6 @@ from werkzeug.utils import secure_filename
 # Ensure uploads folder exists
 os.makedirs('uploads', exist_ok=True)
 
-from flask import send_from_directory
 
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
@@ -79,88 +122,258 @@ def uploaded_file(filename):
 import base64
 
 
-from pdf2image import convert_from_path
+from pdf2image import convert_from_path, pdfinfo_from_path
+from PIL import Image, ImageOps
 import io
 
+# Vision payload limits: the model reads text fine at this size, and
+# phone photos are often 4000px+ colour JPEGs with EXIF attached
+VISION_MAX_SIDE = int(os.getenv("VISION_MAX_SIDE", "1600"))
+VISION_JPEG_QUALITY = int(os.getenv("VISION_JPEG_QUALITY", "80"))
+VISION_GRAYSCALE = os.getenv("VISION_GRAYSCALE", "true").lower() in ("1", "true", "yes")
+
+def prepare_vision_image(img):
+    """
+    Shrinks an image to VISION_MAX_SIDE, optionally to grayscale, and
+    re-encodes it as an optimized JPEG without EXIF.
+    Returns the base64 payload and its size in bytes.
+    """
+    img = ImageOps.exif_transpose(img)  # keep phone photos upright once EXIF is gone
+    if VISION_GRAYSCALE and img.mode != 'L':
+        img = img.convert('L')
+    elif img.mode not in ('L', 'RGB'):
+        img = img.convert('RGB')
+    img.thumbnail((VISION_MAX_SIDE, VISION_MAX_SIDE), Image.LANCZOS)
+    buf = io.BytesIO()
+    img.save(buf, format='JPEG', quality=VISION_JPEG_QUALITY, optimize=True)
+    # Encode straight from the buffer instead of copying its bytes first
+    return base64.b64encode(buf.getbuffer()).decode('ascii'), buf.tell()
+
 def encode_image(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+    """Prepared base64 JPEG of an image file. Returns (base64, original bytes, payload bytes)."""
+    with Image.open(image_path) as img:
+        # JPEG decoders can scale down by 1/2..1/8 while decoding, so a 12 MP photo
+        # is never expanded to full size in memory
+        img.draft('L' if VISION_GRAYSCALE else 'RGB', (VISION_MAX_SIDE, VISION_MAX_SIDE))
+        payload, payload_bytes = prepare_vision_image(img)
+    return payload, os.path.getsize(image_path), payload_bytes
+
+def stream_sha256(fileobj):
+    """Hashes a file object in 64 KB chunks, then rewinds it for the next reader."""
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: fileobj.read(65536), b""):
+        digest.update(chunk)
+    fileobj.seek(0)
+    return digest.hexdigest()
+
+def file_sha256(filepath):
+    with open(filepath, "rb") as f:
+        return stream_sha256(f)
+
+VISION_MODEL = "meta-llama/llama-4-maverick-17b-128e-instruct"
+VISION_PROMPT = "Analyze this student document. Extract Name, Marks, Attendance, and Disciplinary info. Summarize in 2-3 Malayalam sentences."
+# Multi-page documents: facts per page first, then one merged summary
+PAGE_PROMPT = "This is page {page} of {pages} of a school circular or student document. Extract every fact on it (names, dates, marks, attendance, disciplinary notes, instructions) as short bullet points. Reply with only the bullets."
+MERGE_PROMPT = "Below are facts extracted page by page from one school document. Merge them, removing duplicates, and summarize the whole document in 3-6 Malayalam sentences. Keep every date, name and instruction.\n\n{extracts}"
+MERGE_MODEL = "llama-3.3-70b-versatile"
+
+# PDF rasterization limits: pages are rendered one at a time at this DPI,
+# and only the first PDF_MAX_PAGES are analyzed
+PDF_DPI = int(os.getenv("PDF_DPI", "150"))
+PDF_MAX_PAGES = int(os.getenv("PDF_MAX_PAGES", "10"))
+# Pages rendered and in flight to Groq Vision at once (bounds memory too)
+VISION_CONCURRENCY = int(os.getenv("VISION_CONCURRENCY", "3"))
+DOCUMENT_IMAGE_EXTENSIONS = ('jpg', 'jpeg', 'png', 'webp')
+
+# Cached vision results are only reused while the prompts and rendering settings match
+OCR_PROMPT_VERSION = hashlib.sha1("\0".join(
+    [VISION_MODEL, VISION_PROMPT, PAGE_PROMPT, MERGE_PROMPT, MERGE_MODEL, str(PDF_DPI), str(PDF_MAX_PAGES),
+     str(VISION_MAX_SIDE), str(VISION_JPEG_QUALITY), str(VISION_GRAYSCALE)]
+).encode('utf-8')).hexdigest()[:12]
+
+def document_page_count(filepath):
+    """
+    Number of pages to analyze (capped at PDF_MAX_PAGES), read from the PDF
+    header without rendering anything. Returns: (pages, error_message)
+    """
+    ext = filepath.lower().split('.')[-1]
+    if ext in DOCUMENT_IMAGE_EXTENSIONS:
+        return 1, None
+    if ext != 'pdf':
+        return 0, "Unsupported file format. Please use JPG, PNG, or PDF."
+    try:
+        pages = pdfinfo_from_path(filepath)["Pages"]
+    except Exception as pdf_err:
+        return 0, f"PDF Conversion Error: {str(pdf_err)}. Install poppler."
+    if not pages:
+        return 0, "Empty PDF."
+    if pages > PDF_MAX_PAGES:
+        print(f"PDF has {pages} pages; analyzing the first {PDF_MAX_PAGES}")
+    return min(pages, PDF_MAX_PAGES), None
+
+@profiling.profiled("load_page")
+def load_document_page(filepath, page=1):
+    """
+    Reads an image, or renders one page of a PDF at PDF_DPI, as a prepared
+    base64 JPEG. Returns (base64, source bytes, payload bytes); for a PDF
+    page the source is its uncompressed raster.
+    """
+    if filepath.lower().split('.')[-1] in DOCUMENT_IMAGE_EXTENSIONS:
+        return encode_image(filepath)
+    images = convert_from_path(filepath, dpi=PDF_DPI, first_page=page, last_page=page,
+                               fmt='jpeg', grayscale=VISION_GRAYSCALE)
+    if not images:
+        raise ValueError(f"PDF page {page} could not be rendered")
+    img = images[0]
+    try:
+        source_bytes = img.width * img.height * len(img.getbands())
+        payload, payload_bytes = prepare_vision_image(img)
+    finally:
+        img.close()
+    return payload, source_bytes, payload_bytes
+
+@profiling.profiled("vision_extract")
+async def vision_extract(client, base64_image, prompt):
+    # Queued under the Groq Vision quota and retried on 429
+    chat_completion = await scheduler.call_async("groq_vision", lambda: client.chat.completions.create(
+        messages=[
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": prompt},
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:image/jpeg;base64,{base64_image}",
+                        },
+                    },
+                ],
+            }
+        ],
+        model=VISION_MODEL,
+    ))
+    return chat_completion.choices[0].message.content
+
+@profiling.profiled("merge_pages")
+async def merge_page_extracts(client, extracts):
+    """One summary from the per-page facts; falls back to the page list if the merge call fails."""
+    joined = "\n\n".join(f"Page {page}:\n{text}" for page, text in extracts)
+    try:
+        completion = await scheduler.call_async("groq_chat", lambda: client.chat.completions.create(
+            messages=[{"role": "user", "content": MERGE_PROMPT.format(extracts=joined)}],
+            model=MERGE_MODEL,
+        ))
+        return completion.choices[0].message.content
+    except Exception as e:
+        print(f"Page merge failed, keeping per-page extracts: {e}")
+        return joined
 
-def process_file_monitor(filepath):
+async def use_cached_analysis_async(source_hash, source_name=None, class_scope=None):
+    """
+    Learns a file from the OCR cache without reading it.
+    Returns the extracted text, or None if this content hasn't been analyzed yet.
+    """
+    extracted_text = await asyncio.to_thread(database.get_cached_extract, source_hash, OCR_PROMPT_VERSION)
+    if extracted_text is None:
+        return None
+    print(f"OCR cache hit for {source_name or source_hash[:12]}")
+    await asyncio.to_thread(
+        database.add_document_context,
+        extracted_text,
+        source_name=source_name,
+        source_hash=source_hash,
+        class_scope=class_scope
+    )
+    return extracted_text
+
+@profiling.profiled("process_file_monitor")
+async def process_file_monitor_async(filepath, class_scope=None, source_hash=None, on_progress=None):
     """
     Analyzes file using Groq Vision.
-    Converts PDF to images first.
+    PDFs are rendered page by page (up to PDF_MAX_PAGES) and the pages
+    analyzed concurrently, then merged into one summary.
+    Results are cached by content hash, so a re-upload skips Groq entirely.
+    class_scope limits the circular to one class (None = everyone).
+    on_progress(pages_done, pages_total) is called from a worker thread as pages finish.
     Returns: (extracted_text, error_message)
     """
     try:
-        # Determine file type
-        ext = filepath.lower().split('.')[-1]
-        
-        base64_image = None
-        
-        if ext in ['jpg', 'jpeg', 'png', 'webp']:
-            base64_image = encode_image(filepath)
-            
-        elif ext == 'pdf':
-            print("PDF detected. Converting to image for Groq Vision...")
-            try:
-                # Convert first page to image
-                images = convert_from_path(filepath)
-                if not images:
-                    return None, "Empty PDF."
-                
-                # Take first page
-                img = images[0]
-                
-                # Save to bytes
-                img_byte_arr = io.BytesIO()
-                img.save(img_byte_arr, format='JPEG')
-                img_byte_arr = img_byte_arr.getvalue()
-                
-                base64_image = base64.b64encode(img_byte_arr).decode('utf-8')
-                print("PDF converted to image successfully.")
-                
-            except Exception as pdf_err:
-                 return None, f"PDF Conversion Error: {str(pdf_err)}. Install poppler."
+        if source_hash is None:
+            source_hash = await asyncio.to_thread(file_sha256, filepath)
+        cached = await use_cached_analysis_async(source_hash, os.path.basename(filepath), class_scope)
+        if cached is not None:
+            return cached, None
+
+        # Reading the PDF header is disk bound: keep it off the loop
+        pages, error = await asyncio.to_thread(document_page_count, filepath)
+        if error:
+            return None, error
+
+        # Use Groq Vision (Llama 4 Maverick)
+        client = get_async_groq_client()
+        if not client:
+            return None, "Groq API Key missing."
+
+        # Each page is rendered only once it holds a slot, so at most
+        # VISION_CONCURRENCY rasters are in memory at a time
+        slots = asyncio.Semaphore(VISION_CONCURRENCY)
+        pages_done = 0
+        source_total = payload_total = 0
+
+        async def analyze_page(page):
+            nonlocal pages_done, source_total, payload_total
+            async with slots:
+                base64_image, source_bytes, payload_bytes = await asyncio.to_thread(load_document_page, filepath, page)
+                source_total += source_bytes
+                payload_total += payload_bytes
+                prompt = VISION_PROMPT if pages == 1 else PAGE_PROMPT.format(page=page, pages=pages)
+                try:
+                    return await vision_extract(client, base64_image, prompt)
+                finally:
+                    pages_done += 1
+                    if on_progress:
+                        await asyncio.to_thread(on_progress, pages_done, pages)
+
+        results = await asyncio.gather(*(analyze_page(page) for page in range(1, pages + 1)), return_exceptions=True)
+        if source_total:
+            print(f"Image prep for {os.path.basename(filepath)}: {payload_total // 1024} KB sent "
+                  f"instead of {source_total // 1024} KB ({100 - 100 * payload_total // source_total}% saved)")
+        extracts = []
+        for page, result in enumerate(results, 1):
+            if isinstance(result, Exception):
+                print(f"Page {page} analysis failed: {result}")
+            else:
+                extracts.append((page, result))
+        if not extracts:
+            return None, f"Analysis Error: {str(results[0])}"
+
+        if pages == 1:
+            extracted_text = extracts[0][1]
         else:
-            return None, "Unsupported file format. Please use JPG, PNG, or PDF."
-
-        if base64_image:
-            # Use Groq Vision (Llama 3.2 11B Vision)
-            client = get_groq_client()
-            if not client:
-                return None, "Groq API Key missing."
-
-
-            chat_completion = client.chat.completions.create(
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": "Analyze this student document. Extract Name, Marks, Attendance, and Disciplinary info. Summarize in 2-3 Malayalam sentences."},
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{base64_image}",
-                                },
-                            },
-                        ],
-                    }
-                ],
-                model="meta-llama/llama-4-maverick-17b-128e-instruct",
-            )
-            extracted_text = chat_completion.choices[0].message.content
-            print(f"Groq Vision extracted: {extracted_text}")
-
-            # Update Context
-            database.add_document_context(extracted_text)
-            return extracted_text, None
-            
-        return None, "Processing failed."
+            extracted_text = await merge_page_extracts(client, extracts)
+        print(f"Groq Vision extracted ({len(extracts)}/{pages} pages): {extracted_text}")
+
+        # Only complete analyses are cached; a retry may recover the failed pages
+        if len(extracts) == pages:
+            await asyncio.to_thread(database.cache_extract, source_hash, OCR_PROMPT_VERSION, extracted_text, pages)
+
+        # Update Context (kept alongside earlier circulars)
+        await asyncio.to_thread(
+            database.add_document_context,
+            extracted_text,
+            source_name=os.path.basename(filepath),
+            source_hash=source_hash,
+            class_scope=class_scope
+        )
+        return extracted_text, None
 
     except Exception as e:
         return None, f"Analysis Error: {str(e)}"
 
+def process_file_monitor(filepath, class_scope=None, source_hash=None, on_progress=None):
+    """Blocking wrapper for the upload workers; see process_file_monitor_async."""
+    return aio.run_sync(process_file_monitor_async(filepath, class_scope, source_hash, on_progress))
+
 
 
 @app.route('/upload', methods=['POST'])
@@ -171,24 +384,56 @@ def upload_file():
     if file.filename == '':
         return jsonify({"error": "No selected file"}), 400
     
-    filename = secure_filename(file.filename)
+    # Uploads are stored by content, so the same circular is written to disk once
+    source_hash = stream_sha256(file.stream)
+    filename = f"{source_hash[:12]}_{secure_filename(file.filename)}"
     filepath = os.path.join('uploads', filename)
-    file.save(filepath)
-
-    extracted_text, error = process_file_monitor(filepath)
-    
-    if error:
-        err_str = str(error)
-        print(f"Upload Error: {err_str}")
-        if "429" in err_str:
-            return jsonify({"error": "Quota exceeded. Please wait 1 minute and try again."}), 429
-        return jsonify({"error": f"OCR Error: {err_str}"}), 500
-        
+    if not os.path.exists(filepath):
+        file.save(filepath)
+    class_scope = request.form.get('class_scope') or None
+
+    # Already-analyzed content is answered straight from the OCR cache
+    extracted_text = aio.run_sync(use_cached_analysis_async(source_hash, filename, class_scope))
+    if extracted_text is not None:
+        return jsonify({
+            "message": "File uploaded and context updated!",
+            "learned": extracted_text,
+            "file_url": url_for('uploaded_file', filename=filename)
+        })
+
+    job_id = upload_queue.enqueue(filepath, source_hash, class_scope)
     return jsonify({
-        "message": "File uploaded and context updated!",
-        "learned": extracted_text,
+        "message": "File uploaded; analysis queued.",
+        "job_id": job_id,
+        "status_url": url_for('upload_status', job_id=job_id),
         "file_url": url_for('uploaded_file', filename=filename)
-    })
+    }), 202
+
+
+@app.route('/upload/status/<int:job_id>')
+def upload_status(job_id):
+    """Progress of a queued upload; 'learned' is set once it is done."""
+    job = upload_queue.get_job(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    result = {
+        "job_id": job_id,
+        "status": job['status'],
+        "progress": job['progress'],
+        "file_url": url_for('uploaded_file', filename=os.path.basename(job['filepath']))
+    }
+    if job['status'] == 'done':
+        result["message"] = "File uploaded and context updated!"
+        result["learned"] = job['extracted_text']
+    elif job['status'] == 'error':
+        err_str = job['error']
+        print(f"Upload Error: {err_str}")
+        if "429" in err_str:
+            result["error"] = "Quota exceeded. Please wait 1 minute and try again."
+            result["quota_exceeded"] = True
+        else:
+            result["error"] = f"OCR Error: {err_str}"
+    return jsonify(result)
 
 
 # Twilio Setup
@@ -203,35 +448,46 @@ if api_key_sid and api_secret:
 else:
     client = Client(account_sid, auth_token)
 
+# Point the client at a local stand-in (fake_twilio.py) for testing
+if os.getenv("TWILIO_API_BASE_URL"):
+    client.api.base_url = os.getenv("TWILIO_API_BASE_URL").rstrip('/')
+
 
+@profiling.profiled("generate_audio")
 def generate_audio(text):
+    """Returns a stable /audio URL for text; identical text reuses the cached clip."""
     try:
-        # Generate unique filename to avoid browser caching issues during testing
-        filename = f"response_{uuid.uuid4().hex[:6]}.mp3"
-        filepath = os.path.join('static', filename)
-        
-        # Clean up old files (optional, simple safeguard)
-        for f in os.listdir('static'):
-            if f.endswith('.mp3'):
-                try:
-                    os.remove(os.path.join('static', f))
-                except:
-                    pass
-
-        tts = gTTS(text=text, lang='ml')
-        tts.save(filepath)
-        return f"/static/{filename}"
+        return tts.synthesize(text)
     except Exception as e:
         print(f"TTS Error: {e}")
         return None
 
+# Immutable, content-addressed clips: safe for browsers and Twilio to cache forever
+@app.route('/audio/<name>')
+def tts_audio(name):
+    response = send_from_directory(os.path.abspath(tts.TTS_DIR), name, mimetype='audio/mpeg', max_age=31536000)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+# Blocking TTS runs here: streamed sentences are synthesized while Gemini keeps
+# generating, and the async pipeline offloads gTTS to it
+tts_executor = ThreadPoolExecutor(max_workers=int(os.getenv("TTS_WORKERS", "4")), thread_name_prefix="tts")
+
+GREETING_TEXT = "നമസ്കാരം! ഇത് ആരാണ്? ഏത് കുട്ടിയുടെ രക്ഷിതാവാണ്?"
+ERROR_TEXT = "ക്ഷമിക്കണം, സാങ്കേതിക തകരാർ സംഭവിച്ചു."
+
+def web_session_id(data):
+    """Conversation key for a browser tab (the page sends a random session_id)."""
+    session_id = (data or {}).get('session_id')
+    return f"web:{session_id}" if session_id else database.DEFAULT_SESSION
+
 @app.route('/start_conversation', methods=['POST'])
 def start_conversation():
     # Initial greeting logic
-    greeting_text = "നമസ്കാരം! ഇത് ആരാണ്? ഏത് കുട്ടിയുടെ രക്ഷിതാവാണ്?"
+    greeting_text = GREETING_TEXT
     
     # Store initial AI message in DB
-    database.add_conversation("System Start", greeting_text)
+    database.add_conversation("System Start", greeting_text, web_session_id(request.get_json(silent=True)))
     
     audio_url = generate_audio(greeting_text)
     
@@ -252,13 +508,9 @@ def notify_parent():
     # For local dev without env var, this might fail on Twilio side (HTTP 11200)
     
     # We use the /twilio/voice endpoint as the handler
-    webhook_url = url_for('twilio_voice_webhook', _external=True)
-    
-    # If running locally behind ngrok manually, url_for might still say localhost.
-    # Allow override via env
-    public_url_base = os.getenv("PUBLIC_URL")
-    if public_url_base:
-        webhook_url = f"{public_url_base}/twilio/voice"
+    # If running locally behind ngrok manually, url_for might still say localhost,
+    # so PUBLIC_URL overrides it
+    webhook_url = public_url('twilio_voice_webhook')
 
     print(f"Initiating call to {parent_number} with webhook: {webhook_url}")
 
@@ -273,72 +525,205 @@ def notify_parent():
         return f"Failed to initiate call: {str(e)}", 500
 
 
-@app.route('/twilio/voice', methods=['POST'])
-def twilio_voice_webhook():
-    """Handles the TwiML for the interactive voice call."""
-    user_speech = request.form.get('SpeechResult')
-    
-    # Construct absolute URL for the action
-    # This prevents any localhost/relative path issues
+def public_url(endpoint, **values):
+    """Absolute URL Twilio can reach: PUBLIC_URL when set (ngrok), else from the request host."""
     public_url_base = os.getenv("PUBLIC_URL")
     if public_url_base:
-        # Ensure no trailing slash
-        if public_url_base.endswith('/'):
-            public_url_base = public_url_base[:-1]
-        action_url = f"{public_url_base}/twilio/voice"
-    else:
-        # Fallback to external url_for (works if Host header is forwarded correctly)
-        action_url = url_for('twilio_voice_webhook', _external=True)
+        return public_url_base.rstrip('/') + url_for(endpoint, **values)
+    return url_for(endpoint, _external=True, **values)
 
-    
-    if not user_speech:
-        # Case A: Start of Call OR No Input Detected (Twilio Loop)
-        # Check if this is a "re-prompt" due to no input (Twilio sends digits/speech empty)
-        # We can check 'CallStatus'. But simpler: if no speech, just greet or re-prompt.
-        
-        # We can differntiate Start vs Loop using a query param or cookie, but simple is fine:
-        # If it's the very first request (Start), we greet.
-        # IF it's a loop (user stayed silent), we ask "Are you there?" (Simple logic: Random/Context)
-        # For simplicity: Just Greet/Prompt always.
-        
-        ai_text = "നമസ്കാരം! ഇത് ആരാണ്? ഏത് കുട്ടിയുടെ രക്ഷിതാവാണ്? (Hello! Who is this?)"
-        print("AI: Greeting/Prompting...")
-    else:
-        # Case B: User Spoke
-        print(f"User said (Call): {user_speech}")
-        
-        # Get AI Response
-        result, error = get_ai_response(user_speech)
-        
+
+# Voice replies are computed off the webhook thread; Twilio polls for them
+voice_executor = ThreadPoolExecutor(max_workers=int(os.getenv("VOICE_WORKERS", "8")), thread_name_prefix="voice")
+# How long the webhook waits for a reply before answering with a hold + redirect
+VOICE_INLINE_WAIT_SECONDS = float(os.getenv("VOICE_INLINE_WAIT_SECONDS", "2"))
+# Give up on a turn that is still thinking after this long
+VOICE_TURN_TIMEOUT_SECONDS = 45
+VOICE_MAX_SILENCE_RETRIES = 2
+VOICE_HOLD_SECONDS = 1
+
+REPROMPT_TEXT = "Are you there? I did not hear you."
+GOODBYE_TEXT = "നന്ദി. Goodbye."
+VOICE_GREETING_TEXT = "നമസ്കാരം! ഇത് ആരാണ്? ഏത് കുട്ടിയുടെ രക്ഷിതാവാണ്? (Hello! Who is this?)"
+
+
+@profiling.profiled("voice_turn")
+def run_voice_turn(call_sid, turn, user_speech, session_id, parent_phone):
+    """Background half of a voice turn: computes the reply and parks it on the call row."""
+    try:
+        result, error = get_ai_response(user_speech, session_id, parent_phone)
         if error:
-            ai_text = "ക്ഷമിക്കണം, സാങ്കേതിക തകരാർ സംഭവിച്ചു." 
             print(f"Call AI Error: {error}")
+            parked = database.finish_call_turn(call_sid, turn, ERROR_TEXT, generate_audio(ERROR_TEXT), failed=True)
         else:
-            ai_text = result['response']
+            parked = database.finish_call_turn(call_sid, turn, result['response'], result['audio_url'])
+        if not parked:
+            print(f"Call {call_sid}: turn {turn} finished after it timed out, reply dropped")
+    except Exception as e:
+        print(f"Call AI Error: {e}")
+        database.finish_call_turn(call_sid, turn, ERROR_TEXT, failed=True)
+    finally:
+        database.release_connection()
 
-    print(f"AI Replying (Call): {ai_text}")
 
-    # Build TwiML
-    # 1. Say Response
-    # 2. Gather (Listen)
-    # 3. If no input -> Loop back to this webhook (Twilio executes next verb)
-    #    Actually, <Gather> action handles success. 
-    #    If *no* input, it falls through. We should Redirect back to Prompt? 
-    #    Or say "Goodbye". Let's Redirect back to listen again once.
-    
+def twiml_speak(text, audio_url=None):
+    """<Play> the cached clip when there is one, else fall back to Twilio's own voice."""
+    if audio_url:
+        return f"<Play>{public_url('tts_audio', name=os.path.basename(audio_url))}</Play>"
+    return f'<Say language="ml-IN" voice="Google.ml-IN-Standard-A">{escape(text)}</Say>'
 
 
-    twiml_response = f"""<?xml version="1.0" encoding="UTF-8"?>
-<Response>
-    <Say language="ml-IN" voice="Google.ml-IN-Standard-A">{ai_text}</Say>
+def twiml_listen(speech):
+    """Speaks, then gathers the next utterance; silence falls through to the webhook again."""
+    action_url = public_url('twilio_voice_webhook')
+    return twiml_response(f"""{speech}
     <Gather input="speech" action="{action_url}" language="ml-IN" timeout="5" speechTimeout="auto">
     </Gather>
-    <Say language="ml-IN">Are you there? I did not hear you.</Say>
-    <Redirect>{action_url}</Redirect>
-</Response>"""
-    
-    return twiml_response, 200, {'Content-Type': 'application/xml'}
+    <Redirect>{action_url}</Redirect>""")
+
+
+def twiml_hold():
+    """Keeps the line open while the reply is computed, then polls for it."""
+    poll_url = public_url('twilio_voice_poll')
+    return twiml_response(f"""<Pause length="{VOICE_HOLD_SECONDS}"/>
+    <Redirect>{poll_url}</Redirect>""")
+
+
+def twiml_response(body):
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<Response>
+    {body}
+</Response>""", 200, {'Content-Type': 'application/xml'}
+
+
+def twiml_reply(call):
+    print(f"AI Replying (Call): {call['reply_text']}")
+    return twiml_listen(twiml_speak(call['reply_text'], call['reply_audio']))
+
+
+@app.route('/twilio/voice', methods=['POST'])
+def twilio_voice_webhook():
+    """
+    Handles the TwiML for the interactive voice call. Returns at once:
+    the reply is computed in the background and fetched by /twilio/voice/poll.
+    """
+    user_speech = request.form.get('SpeechResult')
+    call_sid = request.form.get('CallSid')
+    if not call_sid:
+        return "Error: CallSid required", 400
+    session_id = f"call:{call_sid}"
+    # The parent is the dialled number on our outbound calls, the caller otherwise
+    if (request.form.get('Direction') or '').startswith('outbound'):
+        parent_phone = request.form.get('To')
+    else:
+        parent_phone = request.form.get('From')
+
+    if database.start_call(call_sid, parent_phone):
+        # Start of the call: greet once
+        print("AI: Greeting...")
+        return twiml_listen(twiml_speak(VOICE_GREETING_TEXT))
+
+    if not user_speech:
+        # The Gather timed out: re-prompt a couple of times, then hang up
+        if database.record_call_silence(call_sid) > VOICE_MAX_SILENCE_RETRIES:
+            return twiml_response(f"{twiml_speak(GOODBYE_TEXT)}\n    <Hangup/>")
+        return twiml_listen(twiml_speak(REPROMPT_TEXT))
+
+    # User Spoke
+    print(f"User said (Call): {user_speech}")
+    turn = database.begin_call_turn(call_sid)
+    if turn is None:
+        # A reply is already being computed for this call; keep waiting for it
+        return twiml_hold()
+    future = voice_executor.submit(run_voice_turn, call_sid, turn, user_speech, session_id, parent_phone)
+
+    # Quick turns are answered in this response; slow ones hold and poll
+    try:
+        future.result(timeout=VOICE_INLINE_WAIT_SECONDS)
+    except FuturesTimeout:
+        return twiml_hold()
+    call = database.take_call_reply(call_sid)
+    return twiml_reply(call) if call else twiml_hold()
+
+
+@app.route('/twilio/voice/poll', methods=['POST'])
+def twilio_voice_poll():
+    """Twilio comes back here during a hold until the reply is ready."""
+    call_sid = request.form.get('CallSid')
+    call = database.get_call(call_sid) if call_sid else None
+    if not call:
+        return twilio_voice_webhook()
+    if call['state'] == 'thinking':
+        if call['turn_age_seconds'] > VOICE_TURN_TIMEOUT_SECONDS:
+            database.finish_call_turn(call_sid, call['turn_count'], ERROR_TEXT, generate_audio(ERROR_TEXT), failed=True)
+        else:
+            return twiml_hold()
+    call = database.take_call_reply(call_sid)
+    if not call:
+        # Nothing pending: go back to listening
+        return twiml_listen("")
+    return twiml_reply(call)
+
+
 
+@app.route('/twilio/status', methods=['POST'])
+def twilio_status():
+    """Twilio call status callbacks for campaign calls."""
+    campaign.handle_status(
+        request.form.get('CallSid'), request.form.get('CallStatus'),
+        call_id=request.args.get('campaign_call', type=int), attempt=request.args.get('attempt', type=int)
+    )
+    return "", 204
+
+
+@app.route('/campaigns', methods=['GET', 'POST'])
+def campaigns():
+    """
+    POST starts a campaign, e.g. {"name": "Jan 25 meeting", "status": "Unknown",
+    "class": "10A", "concurrency": 5, "pacing_seconds": 1, "max_attempts": 3}.
+    GET lists recent campaigns.
+    """
+    if request.method == 'GET':
+        return jsonify(campaign.list_campaigns())
+
+    data = request.get_json(silent=True) or {}
+    try:
+        options = {
+            "concurrency": int(data.get('concurrency', campaign.CAMPAIGN_CONCURRENCY)),
+            "pacing_seconds": float(data.get('pacing_seconds', campaign.CAMPAIGN_PACING_SECONDS)),
+            "max_attempts": int(data.get('max_attempts', campaign.CAMPAIGN_MAX_ATTEMPTS)),
+            "retry_delay_seconds": int(data.get('retry_delay_seconds', campaign.CAMPAIGN_RETRY_DELAY_SECONDS)),
+        }
+    except (TypeError, ValueError):
+        return jsonify({"error": "concurrency, pacing_seconds, max_attempts and retry_delay_seconds must be numbers"}), 400
+    if options["concurrency"] < 1 or options["max_attempts"] < 1:
+        return jsonify({"error": "concurrency and max_attempts must be at least 1"}), 400
+
+    campaign_id, queued = campaign.create_campaign(
+        data.get('name') or "Parent meeting invitation",
+        public_url('twilio_voice_webhook'),
+        public_url('twilio_status'),
+        attendance_status=data.get('status', 'Unknown'),
+        class_info=data.get('class') or None,
+        **options
+    )
+    return jsonify({"id": campaign_id, "queued": queued,
+                    "progress_url": url_for('campaign_progress', campaign_id=campaign_id)}), 201
+
+
+@app.route('/campaigns/<int:campaign_id>')
+def campaign_progress(campaign_id):
+    progress = campaign.get_progress(campaign_id)
+    if progress is None:
+        return jsonify({"error": "Campaign not found"}), 404
+    return jsonify(progress)
+
+
+@app.route('/campaigns/<int:campaign_id>/cancel', methods=['POST'])
+def cancel_campaign(campaign_id):
+    if not campaign.cancel_campaign(campaign_id):
+        return jsonify({"error": "Campaign not found or not running"}), 404
+    return jsonify(campaign.get_progress(campaign_id))
 
 
 @app.route('/')
@@ -348,76 +733,435 @@ def index():
 
 
 
-def get_ai_response(user_text):
-    # Retrieve Gemini Key
-    api_key = os.getenv("GEMINI_API_KEY")
-    if not api_key:
-        return None, "Gemini API key not configured"
-    
-    genai.configure(api_key=api_key)
+# (data version, student) -> formatted prompt, small LRU
+_system_prompt_cache = collections.OrderedDict()
+_system_prompt_lock = threading.Lock()
+SYSTEM_PROMPT_CACHE_SIZE = 256
 
-    try:
-        # 1. Fetch recent history from DB
-        past_convos = database.get_conversations()
-        
-        # Build History for Gemini (User/Model format)
-        history = []
-        recent_convos = past_convos[:10][::-1]
-        for row in recent_convos:
-            history.append({"role": "user", "parts": [row[1]]})
-            history.append({"role": "model", "parts": [row[2]]})
-            
-        # Dynamic System Prompt
-        student_context = database.get_student_context()
-        doc_context = database.get_latest_document_context()
-        formatted_system_prompt = SYSTEM_PROMPT.format(
-            student_context=student_context,
-            doc_context=doc_context
-        )
+def get_system_prompt(student_id=None, user_text=None):
+    """Formats SYSTEM_PROMPT for this caller, reusing it while the data version is unchanged."""
+    key, student_context, doc_context = database.get_prompt_context(student_id, user_text)
+    with _system_prompt_lock:
+        formatted = _system_prompt_cache.get(key) if key else None
+        if formatted:
+            _system_prompt_cache.move_to_end(key)
+            return formatted
+    formatted = SYSTEM_PROMPT.format(
+        student_context=student_context,
+        doc_context=doc_context
+    )
+    if key:
+        with _system_prompt_lock:
+            _system_prompt_cache[key] = formatted
+            while len(_system_prompt_cache) > SYSTEM_PROMPT_CACHE_SIZE:
+                _system_prompt_cache.popitem(last=False)
+    return formatted
 
 
+def identify_student(session_id, user_text, caller_phone=None):
+    """
+    Works out which student this session is about: remembered from earlier
+    turns, else the caller's phone number, else an unambiguous exact name
+    match in what they just said. Returns a student id or None.
+    """
+    student_id = database.get_session_student(session_id)
+    if student_id is not None:
+        return student_id
+    student_id = database.find_student_by_phone(caller_phone)
+    if student_id is None:
+        matches = database.search_students(user_text, limit=2, prefix=False)
+        if len(matches) == 1:
+            student_id = matches[0][0]
+    if student_id is not None:
+        database.set_session_student(session_id, student_id)
+    return student_id
 
 
-        # 2. Call Gemini
-        # Use a model known for good multilingual support
-        model = genai.GenerativeModel(
-            "gemini-2.0-flash-lite-preview-02-05", # Switch to Lite for better quota
-            system_instruction=formatted_system_prompt
-        )
-        
-        chat_session = model.start_chat(history=history)
-        response = chat_session.send_message(user_text)
-        
-        raw_ai_response = response.text
-        
-        # 3. Extract Metadata
-        ai_response = raw_ai_response
-        meta_match = re.search(r'\[\[META:\s*(.*?)\|(.*?)\]\]', raw_ai_response)
-        
+def build_user_message(user_text, student_id=None):
+    """Attaches the top circular passages for this utterance to the parent's message."""
+    class_scope = database.get_student_class(student_id) if student_id is not None else None
+    excerpts = database.search_documents(user_text, class_scope=class_scope)
+    if not excerpts:
+        return user_text
+    return f"[CIRCULAR EXCERPTS]\n{excerpts}\n\n[PARENT SAID]\n{user_text}"
+
+
+META_PATTERN = re.compile(r'\[\[META:\s*(.*?)\|(.*?)\]\]')
+
+
+# Identical questions from the same parent against the same data get the same answer
+response_cache = cache.TTLCache(
+    maxsize=int(os.getenv("RESPONSE_CACHE_SIZE", "512")),
+    ttl=int(os.getenv("RESPONSE_CACHE_TTL", "300"))
+)
+response_flight = cache.SingleFlight()
+
+
+def normalize_utterance(text):
+    return " ".join(re.sub(r'[^\w\s]', ' ', text.lower()).split())
+
+
+def response_cache_key(user_text, student_id, last_reply=""):
+    """
+    (normalized utterance, identified student, context data version, previous reply).
+    The previous reply keeps a bare "yes" from matching answers to different questions.
+    """
+    last_reply_hash = hashlib.sha1(last_reply.encode('utf-8')).hexdigest()
+    return (normalize_utterance(user_text), student_id, database.get_data_version(), last_reply_hash)
+
+
+PreparedTurn = collections.namedtuple(
+    'PreparedTurn', 'student_id chat_session message cache_key system_prompt history prompt_tokens'
+)
+
+
+@profiling.profiled("prepare_turn")
+def prepare_turn(user_text, session_id, caller_phone=None):
+    """
+    Everything before the Gemini call: identify the caller, fit their
+    history into the prompt budget and pick the system prompt.
+    Returns a PreparedTurn.
+    """
+    # 1. Identify the caller and fetch the turns not yet folded into the summary
+    student_id = identify_student(session_id, user_text, caller_phone)
+    summary, summarized_through = database.get_session_summary(session_id)
+    recent_convos = database.get_recent_turns(session_id, prompt.HISTORY_MAX_TURNS, after_id=summarized_through)
+    window_folded = None
+    if len(recent_convos) == prompt.HISTORY_MAX_TURNS:
+        # Unsummarized turns older than the read window are folded now, not silently lost
+        older = database.get_turns_between(session_id, summarized_through, recent_convos[0][0])
+        if older:
+            summary = prompt.fold_into_summary(summary, older)
+            window_folded = older[-1][0]
+
+    # Dynamic System Prompt: only this caller's record (cached until the roster/circular changes)
+    formatted_system_prompt = get_system_prompt(student_id, user_text)
+    message = build_user_message(user_text, student_id)
+
+    # Keep the newest turns that fit the token budget; older ones go into the summary
+    kept, summary, folded_through = prompt.budget_history(recent_convos, formatted_system_prompt, message, summary)
+    folded_through = folded_through or window_folded
+    if folded_through is not None:
+        database.update_session_summary(session_id, summary, folded_through)
+    # The summary rides on the message so the system prompt (and its cached model) stays stable
+    message = prompt.with_summary(message, summary)
+    history_pairs = [(user_part, model_part) for _, user_part, model_part in kept]
+
+    # Build History for Gemini (User/Model format)
+    history = []
+    for user_part, model_part in history_pairs:
+        history.append({"role": "user", "parts": [user_part]})
+        history.append({"role": "model", "parts": [model_part]})
+
+    # Model objects are reused per (model, system prompt) across turns
+    model = llm.get_model(formatted_system_prompt)
+    chat_session = model.start_chat(history=history)
+    last_reply = recent_convos[-1][2] if recent_convos else ""
+    cache_key = response_cache_key(user_text, student_id, last_reply)
+    prompt_tokens = (prompt.estimate_tokens(formatted_system_prompt) + prompt.estimate_tokens(message)
+                     + sum(prompt.turn_tokens(u, m) for u, m in history_pairs))
+    return PreparedTurn(
+        student_id, chat_session, message, cache_key,
+        formatted_system_prompt, history_pairs, prompt_tokens
+    )
+
+
+@profiling.profiled("finish_turn")
+def finish_turn(raw_ai_response, user_text, session_id, student_id, prompt_tokens=None):
+    """Applies the META tag, logs the turn and returns the cleaned response text."""
+    # 3. Extract Metadata
+    ai_response = raw_ai_response
+    meta_match = META_PATTERN.search(raw_ai_response)
+    
+    # 4. Save turn to DB (attendance update + log in one transaction)
+    with database.transaction():
         if meta_match:
             p_name = meta_match.group(1).strip()
             status = meta_match.group(2).strip()
             
+            # The model has identified the parent: remember it for later turns
+            if student_id is None:
+                student_id = database.find_student_by_parent(p_name)
+                if student_id is not None:
+                    database.set_session_student(session_id, student_id)
+            
             # Update DB if we have valid data
-            if p_name in ['Basheer', 'Rafeek', 'Aimu'] and status in ['Confirmed', 'Declined']:
-                database.update_attendance(p_name, status)
+            if student_id is not None and status in ['Confirmed', 'Declined']:
+                database.update_attendance(p_name, status, student_id)
             
             # Clean response for user/TTS
-            ai_response = re.sub(r'\[\[META:.*?\]\]', '', raw_ai_response).strip()
+            ai_response = META_PATTERN.sub('', raw_ai_response).strip()
+
+        database.add_conversation(user_text, ai_response, session_id, prompt_tokens)
+    return ai_response
+
+
+# Optional fallback chat model on Groq for when Gemini's quota is exhausted
+CHAT_FAILOVER = os.getenv("CHAT_FAILOVER", "").lower() in ("1", "true", "yes")
+CHAT_FAILOVER_MODEL = os.getenv("CHAT_FAILOVER_MODEL", "llama-3.3-70b-versatile")
+
+
+async def gemini_reply(turn):
+    response = await turn.chat_session.send_message_async(turn.message)
+    return response.text
+
+
+async def groq_reply(turn):
+    """Same turn (system prompt, history, message) sent to the Groq failover model."""
+    messages = [{"role": "system", "content": turn.system_prompt}]
+    for user_part, model_part in turn.history:
+        messages.append({"role": "user", "content": user_part})
+        messages.append({"role": "assistant", "content": model_part})
+    messages.append({"role": "user", "content": turn.message})
+    completion = await get_async_groq_client().chat.completions.create(
+        messages=messages,
+        model=CHAT_FAILOVER_MODEL,
+    )
+    return completion.choices[0].message.content
+
+
+def chat_providers(turn):
+    providers = [("gemini", lambda: gemini_reply(turn))]
+    if CHAT_FAILOVER and os.getenv("GROQ_API_KEY"):
+        providers.append(("groq_chat", lambda: groq_reply(turn)))
+    return providers
 
-        # 4. Save turn to DB
-        database.add_conversation(user_text, ai_response)
+
+def revalidate_audio(cache_key, cached):
+    """
+    Cached replies can outlive their clip (the TTS cache evicts by LRU), and
+    a streamed reply whose sentences didn't all synthesize has none;
+    re-synthesizes it so a cached reply never points at a 404.
+    """
+    raw_ai_response, audio_url = cached
+    path = tts.local_path(audio_url)
+    if audio_url and (path is None or os.path.exists(path)):
+        return cached
+    cached = (raw_ai_response, generate_audio(META_PATTERN.sub('', raw_ai_response).strip()))
+    if cached[1]:
+        response_cache.set(cache_key, cached)
+    return cached
+
+
+def cache_streamed_reply(cache_key, flight, raw_ai_response, clips):
+    """
+    Runs on the TTS pool after a streamed turn's sentence clips (futures,
+    submitted before this) finish: joins them into one clip for the whole
+    reply, caches the pair like /chat does and hands it to identical turns
+    waiting on the stream. Nothing is synthesized twice.
+    """
+    try:
+        urls = [future.result() for future in clips]
+        text = META_PATTERN.sub('', raw_ai_response).strip()
+        audio_url = tts.join(urls, text) if urls and all(urls) else None
+        result = (raw_ai_response, audio_url)
+        if audio_url:
+            response_cache.set(cache_key, result)
+        response_flight.settle(cache_key, flight, result)
+    except Exception as e:
+        response_flight.settle(cache_key, flight, error=e)
+
+
+async def generate_audio_async(text):
+    """gTTS is blocking network I/O, so it runs on the TTS pool (in this task's context, for profiling)."""
+    return await asyncio.get_running_loop().run_in_executor(
+        tts_executor, contextvars.copy_context().run, generate_audio, text
+    )
+
+
+@profiling.profiled("get_ai_response")
+async def get_ai_response_async(user_text, session_id=database.DEFAULT_SESSION, caller_phone=None, with_audio=True):
+    """
+    Runs one turn. with_audio=False skips TTS (audio_url is None) for callers
+    that synthesize the reply themselves, like the Telegram bot.
+    """
+    # Gemini is configured once per process
+    if not llm.configure():
+        return None, "Gemini API key not configured"
+
+    try:
+        # SQLite work runs in worker threads so the event loop never blocks on it
+        turn = await asyncio.to_thread(prepare_turn, user_text, session_id, caller_phone)
+        student_id, cache_key = turn.student_id, turn.cache_key
+
+        async def generate():
+            # 2. Call Gemini (queued under our quota; Groq takes over if Gemini is saturated)
+            with profiling.span("llm"):
+                provider, raw = await scheduler.call_with_failover_async(chat_providers(turn))
+            if not with_audio:
+                return raw, None
+            return raw, await generate_audio_async(META_PATTERN.sub('', raw).strip())
+
+        # Text-only replies are kept under their own key so a caller that
+        # wants audio is never handed one without it
+        flight_key = cache_key if with_audio else cache_key + ("text",)
+        cached = response_cache.get(cache_key) or (None if with_audio else response_cache.get(flight_key))
+        if cached is None:
+            # Concurrent identical requests share one Gemini + TTS call
+            cached, shared = await response_flight.do_async(flight_key, generate)
+            if not shared:
+                response_cache.set(flight_key, cached)
+        if with_audio:
+            cached = await asyncio.to_thread(revalidate_audio, flight_key, cached)
+        raw_ai_response, audio_url = cached
         
-        audio_url = generate_audio(ai_response)
+        # Every caller still gets its own turn logged and META applied
+        ai_response = await asyncio.to_thread(
+            finish_turn, raw_ai_response, user_text, session_id, student_id, turn.prompt_tokens
+        )
         
         return {
             "response": ai_response,
-            "audio_url": audio_url
+            "audio_url": audio_url,
+            "prompt_tokens": turn.prompt_tokens
         }, None
     except Exception as e:
         return None, str(e)
 
 
+def get_ai_response(user_text, session_id=database.DEFAULT_SESSION, caller_phone=None):
+    """Blocking wrapper for Flask routes; runs the async pipeline on the shared loop."""
+    return aio.run_sync(get_ai_response_async(user_text, session_id, caller_phone))
+
+
+class SentenceSplitter:
+    """
+    Cuts streamed model text into complete sentences for TTS.
+    Anything from "[[" onwards is held back, so the trailing META tag is
+    never shown or spoken.
+    """
+    BOUNDARY = re.compile(r'[.!?।]+\s+|\n+')
+
+    def __init__(self):
+        self.raw = ""
+        self.visible_len = 0   # visible characters already returned as text deltas
+        self.spoken_len = 0    # visible characters already cut into sentences
+
+    def _visible(self):
+        cut = self.raw.find("[[")
+        if cut == -1:
+            # A lone trailing "[" may be the start of the tag
+            cut = len(self.raw) - 1 if self.raw.endswith("[") else len(self.raw)
+        return self.raw[:cut]
+
+    def feed(self, chunk):
+        """Returns (new visible text, list of newly completed sentences)."""
+        self.raw += chunk
+        visible = self._visible()
+        delta = visible[self.visible_len:]
+        self.visible_len = len(visible)
+
+        sentences = []
+        for match in self.BOUNDARY.finditer(visible, self.spoken_len):
+            sentence = visible[self.spoken_len:match.end()].strip()
+            if sentence:
+                sentences.append(sentence)
+            self.spoken_len = match.end()
+        return delta, sentences
+
+    def flush(self):
+        """Returns (remaining visible text, final sentence or None) once the stream ends."""
+        visible = META_PATTERN.sub('', self.raw)
+        if "[[" in visible:
+            visible = visible[:visible.find("[[")]
+        delta = visible[self.visible_len:]
+        self.visible_len = len(visible)
+        rest = visible[self.spoken_len:].strip()
+        self.spoken_len = len(visible)
+        return delta, rest or None
+
+
+def stream_ai_response(user_text, session_id=database.DEFAULT_SESSION, caller_phone=None):
+    """
+    Streaming variant of get_ai_response. Yields event dicts:
+      {"type": "text", "text": ...}                       as tokens arrive
+      {"type": "audio", "index": n, "url": ..., "text": ...}  per sentence, in order
+      {"type": "done", "response": ..., "prompt_tokens": n}  after the turn is saved
+      {"type": "error", "error": ...}
+    """
+    if not llm.configure():
+        yield {"type": "error", "error": "Gemini API key not configured"}
+        return
+
+    pending = []  # (index, sentence, future) awaiting delivery, in order
+    clips = []    # every sentence's future, in order, for cache_streamed_reply
+    next_index = 0
+
+    def submit(sentence):
+        nonlocal next_index
+        future = tts_executor.submit(generate_audio, sentence)
+        pending.append((next_index, sentence, future))
+        clips.append(future)
+        next_index += 1
+
+    def ready_audio(wait=False):
+        while pending and (wait or pending[0][2].done()):
+            index, sentence, future = pending.pop(0)
+            yield {"type": "audio", "index": index, "url": future.result(), "text": sentence}
+
+    flight = None  # set while this stream leads identical concurrent turns
+    failure = None
+    try:
+        turn = prepare_turn(user_text, session_id, caller_phone)
+        student_id, cache_key = turn.student_id, turn.cache_key
+
+        cached = response_cache.get(cache_key)
+        if cached is None:
+            future, leader = response_flight.join(cache_key)
+            if leader:
+                flight = future
+            else:
+                # An identical turn is already generating: replay its answer
+                cached = future.result()
+        if cached is not None:
+            raw_ai_response, audio_url = revalidate_audio(cache_key, cached)
+            ai_response = finish_turn(raw_ai_response, user_text, session_id, student_id, turn.prompt_tokens)
+            yield {"type": "text", "text": ai_response}
+            yield {"type": "audio", "index": 0, "url": audio_url, "text": ai_response}
+            yield {"type": "done", "response": ai_response, "prompt_tokens": turn.prompt_tokens}
+            return
+
+        splitter = SentenceSplitter()
+
+        # send_message fetches the first chunk, so a 429 surfaces (and is retried)
+        # here, before anything is yielded; a stream can't be retried halfway
+        response = scheduler.call("gemini", lambda: turn.chat_session.send_message(turn.message, stream=True))
+        for chunk in response:
+            try:
+                text = chunk.text
+            except ValueError:
+                # Chunks without text parts (e.g. the final finish_reason chunk)
+                continue
+            delta, sentences = splitter.feed(text)
+            if delta:
+                yield {"type": "text", "text": delta}
+            for sentence in sentences:
+                submit(sentence)
+            yield from ready_audio()
+
+        delta, last_sentence = splitter.flush()
+        if delta:
+            yield {"type": "text", "text": delta}
+        if last_sentence:
+            submit(last_sentence)
+
+        ai_response = finish_turn(splitter.raw, user_text, session_id, student_id, turn.prompt_tokens)
+        # Queued behind every sentence clip, so waiting on them can't starve the pool
+        tts_executor.submit(cache_streamed_reply, cache_key, flight, splitter.raw, clips)
+        flight = None
+        yield from ready_audio(wait=True)
+        yield {"type": "done", "response": ai_response, "prompt_tokens": turn.prompt_tokens}
+    except Exception as e:
+        failure = e
+        for _, _, future in pending:
+            future.cancel()
+        yield {"type": "error", "error": str(e)}
+    finally:
+        # Failed or abandoned mid-stream: release identical turns waiting on it
+        if flight is not None:
+            response_flight.settle(cache_key, flight, error=failure or RuntimeError("stream closed before the reply finished"))
+
+
 @app.route('/chat', methods=['POST'])
 def chat():
     data = request.json
@@ -425,7 +1169,7 @@ def chat():
     if not user_text:
         return jsonify({"error": "No text provided"}), 400
 
-    result, error = get_ai_response(user_text)
+    result, error = get_ai_response(user_text, web_session_id(data))
     
     if error:
         if "429" in error or "Resource has been exhausted" in error:
@@ -434,15 +1178,185 @@ def chat():
 
     return jsonify(result)
 
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """Server-Sent Events version of /chat: text as it is generated, audio per sentence."""
+    data = request.json
+    user_text = data.get('text')
+    if not user_text:
+        return jsonify({"error": "No text provided"}), 400
+    session_id = web_session_id(data)
+
+    def events():
+        try:
+            for event in stream_ai_response(user_text, session_id):
+                if event["type"] == "error" and ("429" in event["error"] or "Resource has been exhausted" in event["error"]):
+                    event["error"] = "Quota exceeded. Please wait ~1 minute and try again."
+                yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+        finally:
+            database.release_connection()
+
+    return Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
 @app.route('/get_context')
 def get_context():
     text = database.get_latest_document_context()
     return jsonify({"context": text})
 
+@app.route('/students/import', methods=['POST'])
+def import_students():
+    """Bulk upsert of a CSV/JSON/JSONL roster, streamed straight from the request."""
+    if 'file' not in request.files:
+        return jsonify({"error": "No file part"}), 400
+    file = request.files['file']
+    try:
+        fmt = request.form.get('format') or roster.detect_format(file.filename or '')
+        stream = io.TextIOWrapper(file.stream, encoding='utf-8', newline='')
+        imported, skipped = roster.import_file(stream, fmt, batch_size=request.form.get('batch_size', 1000, type=int))
+    except (ValueError, UnicodeDecodeError) as e:
+        return jsonify({"error": f"Import Error: {e}"}), 400
+    return jsonify({"imported": imported, "skipped": skipped})
+
+@app.route('/students')
+def list_students():
+    limit = min(request.args.get('limit', 100, type=int), 1000)
+    offset = request.args.get('offset', 0, type=int)
+    rows = database.list_students(request.args.get('class'), limit, offset)
+    keys = ('id', 'student_name', 'parent_name', 'class_info', 'roll_number', 'attendance_status')
+    return jsonify({"students": [dict(zip(keys, row)) for row in rows], "limit": limit, "offset": offset})
+
+@app.route('/admin/storage')
+def storage_stats():
+    stats = retention.get_storage_stats()
+    stats["tts_cache"] = tts.stats()
+    return jsonify(stats)
+
+@app.route('/admin/profiles')
+def profile_dumps():
+    """Recent slow-turn and profile dumps in PROFILE_DIR."""
+    return jsonify({
+        "slow_turn_seconds": profiling.SLOW_TURN_SECONDS,
+        "mode": profiling.parse_mode(profiling.PROFILE_MODE),
+        "dumps": profiling.list_dumps(),
+    })
+
+@app.route('/admin/scheduler')
+def scheduler_stats():
+    return jsonify(scheduler.stats())
+
+@app.route('/admin/ocr_cache')
+def ocr_cache_stats():
+    stats = database.get_ocr_cache_stats()
+    stats["prompt_version"] = OCR_PROMPT_VERSION
+    return jsonify(stats)
+
+@app.route('/admin/prompt_stats')
+def prompt_stats():
+    """Estimated prompt size per turn, to watch the budget and summary at work."""
+    stats = database.get_prompt_size_stats()
+    stats["budget"] = prompt.PROMPT_TOKEN_BUDGET
+    return jsonify(stats)
+
+REPORT_PAGE_SIZE = 50
+
 @app.route('/report')
 def report():
-    students = database.get_attendance_report()
-    return render_template('report.html', students=students)
+    class_info = request.args.get('class') or None
+    status = request.args.get('status') or None
+    search = request.args.get('q') or None
+    page = max(request.args.get('page', 1, type=int), 1)
+
+    students = database.get_attendance_report(
+        class_info, status, search, limit=REPORT_PAGE_SIZE, offset=(page - 1) * REPORT_PAGE_SIZE
+    )
+    total = database.count_attendance_report(class_info, status, search)
+    return render_template(
+        'report.html',
+        students=students,
+        summary=database.get_attendance_summary(class_info),
+        classes=database.get_report_classes(),
+        statuses=database.ATTENDANCE_STATUSES,
+        filters={"class": class_info or "", "status": status or "", "q": search or ""},
+        page=page,
+        pages=max((total + REPORT_PAGE_SIZE - 1) // REPORT_PAGE_SIZE, 1),
+        total=total,
+        last_change_id=database.get_last_attendance_change_id()
+    )
+
+REPORT_POLL_SECONDS = 1
+REPORT_KEEPALIVE_SECONDS = 15
+
+@app.route('/report/stream')
+def report_stream():
+    """Server-Sent Events: one 'attendance' event per RSVP change, plus refreshed summary counts."""
+    class_info = request.args.get('class') or None
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    if last_id is None:
+        last_id = request.args.get('since', type=int)
+    if last_id is None:
+        last_id = database.get_last_attendance_change_id()
+
+    def events():
+        nonlocal last_id
+        idle = 0
+        try:
+            # Tells the browser how soon to reconnect; also flushes headers right away
+            yield "retry: 3000\n\n"
+            while True:
+                changes = database.get_attendance_changes(last_id)
+                for log_id, student_id, student_name, parent_name, roll_number, status, row_class in changes:
+                    last_id = log_id
+                    row = {
+                        "id": student_id, "student_name": student_name, "parent_name": parent_name,
+                        "roll_number": roll_number, "attendance_status": status, "class_info": row_class
+                    }
+                    yield f"id: {log_id}\nevent: attendance\ndata: {json.dumps(row)}\n\n"
+                if changes:
+                    summary = database.get_attendance_summary(class_info)
+                    yield f"event: summary\ndata: {json.dumps(summary)}\n\n"
+                    idle = 0
+                else:
+                    idle += REPORT_POLL_SECONDS
+                    if idle >= REPORT_KEEPALIVE_SECONDS:
+                        yield ": keepalive\n\n"
+                        idle = 0
+                    time.sleep(REPORT_POLL_SECONDS)
+        finally:
+            database.release_connection()
+
+    return Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+# Set in the environment of the process(es) that should dial campaigns and
+# run retention when app is imported (e.g. under gunicorn); the Telegram
+# bot imports app too and must not start them
+BACKGROUND_WORKERS = os.getenv("BACKGROUND_WORKERS", "").lower() in ("1", "true", "yes")
+
+
+def start_background_workers():
+    """
+    Starts the campaign dispatcher, retention and the TTS prewarm.
+    Runs from `python app.py` or with BACKGROUND_WORKERS set, never on a
+    plain import, and never in the debug reloader's watcher (see below).
+    """
+    # Opt-in background archival/vacuum of the conversation log
+    if os.getenv("RETENTION_INTERVAL_HOURS"):
+        retention.start_scheduler(float(os.getenv("RETENTION_INTERVAL_HOURS")))
+    # Dials new campaigns and resumes ones that were running when the server stopped
+    campaign.start_worker(client, twilio_number)
+    # Fixed phrases are synthesized in the background at startup, so the first caller doesn't wait
+    tts_executor.submit(tts.prewarm, [GREETING_TEXT, ERROR_TEXT])
+
+
+# `python app.py` runs the debug reloader: this file is loaded both in the
+# watcher process and in the child that serves (WERKZEUG_RUN_MAIN=true).
+# Only the serving process may dial, analyze uploads or run retention.
+reloader_watcher = __name__ == '__main__' and os.environ.get('WERKZEUG_RUN_MAIN') != 'true'
+if not reloader_watcher:
+    # Analyses run on the upload queue's pool, never on a request thread;
+    # every process that accepts uploads (web workers, the bot) needs one
+    upload_queue.start(process_file_monitor)
+    if __name__ == '__main__' or BACKGROUND_WORKERS:
+        start_background_workers()
 
 if __name__ == '__main__':
     app.run(port=5001, debug=True)
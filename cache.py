@@ -0,0 +1,121 @@
+"""
+Small in-process caching helpers shared by the app and the bot.
+
+TTLCache      thread-safe LRU with per-entry expiry
+SingleFlight  collapses concurrent calls for the same key into one
+"""
+import asyncio
+import collections
+import threading
+import time
+from concurrent.futures import Future
+
+
+class TTLCache:
+    def __init__(self, maxsize=512, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return entry[1] if entry else default
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {"size": len(self._data), "maxsize": self.maxsize, "ttl": self.ttl,
+                "hits": self.hits, "misses": self.misses}
+
+
+class SingleFlight:
+    """
+    The first caller for a key runs fn(); callers arriving while it is in
+    flight wait for the same result (or exception) instead of repeating it.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def _join(self, key):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+        return future, leader
+
+    def _settle(self, key, future, fn_result=None, error=None):
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(fn_result)
+        with self._lock:
+            del self._calls[key]
+
+    def join(self, key):
+        """
+        For work that can't be wrapped in one call (e.g. a stream): returns
+        (future, leader). Followers wait on the future; the leader must
+        settle() it, with a result or an error, exactly once.
+        """
+        return self._join(key)
+
+    def settle(self, key, future, result=None, error=None):
+        self._settle(key, future, result, error)
+
+    def do(self, key, fn):
+        """Returns (result, shared) where shared is True if another caller did the work."""
+        future, leader = self._join(key)
+        if not leader:
+            return future.result(), True
+        try:
+            result = fn()
+        except BaseException as e:
+            self._settle(key, future, error=e)
+            raise
+        self._settle(key, future, result)
+        return result, False
+
+    async def do_async(self, key, coro_fn):
+        """Async form of do(); sync and async callers of the same key share one call."""
+        future, leader = self._join(key)
+        if not leader:
+            return await asyncio.wrap_future(future), True
+        try:
+            result = await coro_fn()
+        except BaseException as e:
+            self._settle(key, future, error=e)
+            raise
+        self._settle(key, future, result)
+        return result, False
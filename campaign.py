@@ -0,0 +1,317 @@
+"""
+Outbound call campaigns.
+
+A campaign selects parents from `students` (e.g. everyone whose
+attendance_status is still 'Unknown') and dials them through a background
+worker: at most `concurrency` calls live at once, one new call every
+`pacing_seconds`. Both limits are claimed in the database, so they hold
+however many processes run a dispatcher. Twilio status callbacks (/twilio/status) move each call
+along; busy and no-answer calls are re-queued after `retry_delay_seconds`
+until `max_attempts` is reached.
+
+For local testing, run fake_twilio.py and point the client at it with
+TWILIO_API_BASE_URL=http://localhost:5055.
+"""
+import os
+import threading
+import time
+from urllib.parse import urlencode, urlsplit, urlunsplit
+
+from dotenv import load_dotenv
+
+import database
+
+load_dotenv()
+
+CAMPAIGN_CONCURRENCY = int(os.getenv("CAMPAIGN_CONCURRENCY", "5"))
+CAMPAIGN_PACING_SECONDS = float(os.getenv("CAMPAIGN_PACING_SECONDS", "1"))
+CAMPAIGN_MAX_ATTEMPTS = int(os.getenv("CAMPAIGN_MAX_ATTEMPTS", "3"))
+CAMPAIGN_RETRY_DELAY_SECONDS = int(os.getenv("CAMPAIGN_RETRY_DELAY_SECONDS", "600"))
+# A call with no final status after this long lost its callback; give up on it
+STALE_CALL_SECONDS = 900
+POLL_SECONDS = 1.0
+
+ACTIVE_STATUSES = ('dialing', 'ringing', 'in-progress')
+FINAL_STATUSES = ('completed', 'busy', 'no-answer', 'failed', 'canceled')
+RETRY_STATUSES = ('busy', 'no-answer')
+
+# Twilio CallStatus -> campaign call status
+TWILIO_STATUSES = {
+    'queued': 'dialing',
+    'initiated': 'dialing',
+    'ringing': 'ringing',
+    'in-progress': 'in-progress',
+    'answered': 'in-progress',
+    'completed': 'completed',
+    'busy': 'busy',
+    'no-answer': 'no-answer',
+    'failed': 'failed',
+    'canceled': 'canceled',
+}
+
+CAMPAIGN_COLUMNS = ('id', 'name', 'concurrency', 'pacing_seconds', 'max_attempts',
+                    'retry_delay_seconds', 'state', 'created_at')
+
+
+def create_campaign(name, voice_url, status_url, attendance_status='Unknown', class_info=None,
+                    concurrency=CAMPAIGN_CONCURRENCY, pacing_seconds=CAMPAIGN_PACING_SECONDS,
+                    max_attempts=CAMPAIGN_MAX_ATTEMPTS, retry_delay_seconds=CAMPAIGN_RETRY_DELAY_SECONDS):
+    """
+    Creates a campaign and queues one call per parent phone matching the filters
+    (siblings share a call). Returns (campaign id, number of calls queued).
+    """
+    with database.transaction() as c:
+        c.execute('''
+            INSERT INTO campaigns (name, voice_url, status_url, concurrency, pacing_seconds, max_attempts, retry_delay_seconds)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (name, voice_url, status_url, concurrency, pacing_seconds, max_attempts, retry_delay_seconds))
+        campaign_id = c.lastrowid
+
+        clauses = ["parent_phone IS NOT NULL", "parent_phone != ''"]
+        params = [campaign_id]
+        if attendance_status:
+            clauses.append("IFNULL(attendance_status, 'Unknown') = ?")
+            params.append(attendance_status)
+        if class_info:
+            clauses.append("class_info = ?")
+            params.append(class_info)
+        c.execute(f'''
+            INSERT OR IGNORE INTO campaign_calls (campaign_id, student_id, phone)
+            SELECT ?, min(id), parent_phone FROM students
+            WHERE {" AND ".join(clauses)} GROUP BY parent_phone
+        ''', params)
+        queued = c.rowcount
+    print(f"Campaign {campaign_id} '{name}': {queued} calls queued")
+    return campaign_id, queued
+
+
+def _settle(c, call_id, status, error=None):
+    """Records a call outcome; busy/no-answer (and API errors) are re-queued while attempts remain."""
+    c.execute('''
+        SELECT cc.attempts, ca.max_attempts, ca.retry_delay_seconds, ca.state
+        FROM campaign_calls cc JOIN campaigns ca ON ca.id = cc.campaign_id WHERE cc.id = ?
+    ''', (call_id,))
+    attempts, max_attempts, retry_delay, state = c.fetchone()
+    retry = (status in RETRY_STATUSES or error is not None) and attempts < max_attempts and state == 'running'
+    if retry:
+        c.execute('''
+            UPDATE campaign_calls SET status = 'queued', last_error = ?,
+                next_attempt_at = datetime('now', ?), updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', (error or status, f'+{int(retry_delay)} seconds', call_id))
+    else:
+        c.execute('''
+            UPDATE campaign_calls SET status = ?, last_error = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?
+        ''', (status, error, call_id))
+
+
+def callback_url(status_url, call_id, attempt):
+    """The status callback URL for one dial attempt, tagged with the campaign call id."""
+    parts = urlsplit(status_url)
+    query = "&".join(filter(None, [parts.query, urlencode({"campaign_call": call_id, "attempt": attempt})]))
+    return urlunsplit(parts._replace(query=query))
+
+
+def handle_status(call_sid, call_status, call_id=None, attempt=None):
+    """
+    Applies a Twilio status callback. Returns False if the call isn't part
+    of a campaign. Callbacks are matched on the campaign call id from
+    callback_url(), so one that arrives before calls.create() returns still
+    finds its row; callbacks without it fall back to the call SID. Late or
+    out-of-order callbacks (or ones from an earlier attempt) are ignored.
+    """
+    status = TWILIO_STATUSES.get(call_status)
+    if status is None or not (call_sid or call_id):
+        return False
+    with database.transaction() as c:
+        if call_id is not None:
+            c.execute('SELECT id, status, attempts FROM campaign_calls WHERE id = ?', (call_id,))
+        else:
+            c.execute('SELECT id, status, attempts FROM campaign_calls WHERE call_sid = ?', (call_sid,))
+        row = c.fetchone()
+        if not row:
+            return False
+        call_id, current, attempts = row
+        if attempt is not None and attempt != attempts:
+            return True
+        if current not in ACTIVE_STATUSES:
+            return True
+        if call_sid:
+            c.execute('UPDATE campaign_calls SET call_sid = ? WHERE id = ? AND call_sid IS NULL', (call_sid, call_id))
+        if status in FINAL_STATUSES:
+            _settle(c, call_id, status)
+        elif ACTIVE_STATUSES.index(status) > ACTIVE_STATUSES.index(current):
+            c.execute('''
+                UPDATE campaign_calls SET status = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?
+            ''', (status, call_id))
+    return True
+
+
+def _claim_next(campaign_id, concurrency):
+    """
+    Takes the next due call if the campaign is under its concurrency limit
+    and its pacing interval has passed, marking it 'dialing' before any
+    request goes out. Returns (id, phone, attempt number) or None.
+    """
+    with database.transaction() as c:
+        placeholders = ", ".join("?" * len(ACTIVE_STATUSES))
+        c.execute(f'''
+            SELECT count(*) FROM campaign_calls WHERE campaign_id = ? AND status IN ({placeholders})
+        ''', (campaign_id, *ACTIVE_STATUSES))
+        if c.fetchone()[0] >= concurrency:
+            return None
+        c.execute('''
+            SELECT id, phone FROM campaign_calls
+            WHERE campaign_id = ? AND status = 'queued' AND next_attempt_at <= CURRENT_TIMESTAMP
+            ORDER BY next_attempt_at, id LIMIT 1
+        ''', (campaign_id,))
+        row = c.fetchone()
+        if not row:
+            return None
+        # Pacing lives on the campaign row; a clock that went backwards doesn't stall it
+        now = time.time()
+        c.execute('''
+            UPDATE campaigns SET last_dialed_at = ?
+            WHERE id = ? AND (last_dialed_at IS NULL OR ? - last_dialed_at >= pacing_seconds OR last_dialed_at > ?)
+        ''', (now, campaign_id, now, now))
+        if not c.rowcount:
+            return None
+        c.execute('''
+            UPDATE campaign_calls SET status = 'dialing', attempts = attempts + 1, call_sid = NULL,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', (row[0],))
+        c.execute('SELECT attempts FROM campaign_calls WHERE id = ?', (row[0],))
+        return (*row, c.fetchone()[0])
+
+
+def _dial(client, from_number, voice_url, status_url, call_id, phone, attempt):
+    try:
+        call = client.calls.create(
+            from_=from_number,
+            to=phone,
+            url=voice_url,
+            status_callback=callback_url(status_url, call_id, attempt),
+            status_callback_event=['initiated', 'ringing', 'answered', 'completed'],
+            status_callback_method='POST'
+        )
+    except Exception as e:
+        print(f"Campaign dial to {phone} failed: {e}")
+        with database.transaction() as c:
+            _settle(c, call_id, 'failed', str(e))
+        return
+    with database.transaction() as c:
+        c.execute('''
+            UPDATE campaign_calls SET call_sid = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ? AND attempts = ?
+        ''', (call.sid, call_id, attempt))
+
+
+def _expire_stale_calls():
+    placeholders = ", ".join("?" * len(ACTIVE_STATUSES))
+    query = f'''
+        SELECT id FROM campaign_calls
+        WHERE status IN ({placeholders}) AND updated_at < datetime('now', ?)
+    '''
+    params = (*ACTIVE_STATUSES, f'-{STALE_CALL_SECONDS} seconds')
+    # Checked without the write lock first: the dispatcher polls this every second
+    if not database.get_connection().execute(query + ' LIMIT 1', params).fetchone():
+        return
+    with database.transaction() as c:
+        c.execute(query, params)
+        for (call_id,) in c.fetchall():
+            _settle(c, call_id, 'failed', 'no final status from Twilio')
+
+
+def _finish_drained_campaigns():
+    """Marks running campaigns with nothing queued or in flight as done."""
+    with database.transaction() as c:
+        c.execute('''
+            UPDATE campaigns SET state = 'done'
+            WHERE state = 'running' AND NOT EXISTS (
+                SELECT 1 FROM campaign_calls
+                WHERE campaign_id = campaigns.id AND status IN ('queued', 'dialing', 'ringing', 'in-progress')
+            )
+        ''')
+
+
+def _running_campaigns():
+    return database.get_connection().execute('''
+        SELECT id, voice_url, status_url, concurrency, pacing_seconds FROM campaigns WHERE state = 'running'
+    ''').fetchall()
+
+
+def run_worker(client, from_number, stop_event=None):
+    """
+    Dispatch loop: paces and caps dialing per campaign. Runs until stop_event
+    is set. Any number of these may run, in any number of processes.
+    """
+    while not (stop_event and stop_event.is_set()):
+        nap = POLL_SECONDS
+        try:
+            _expire_stale_calls()
+            running = _running_campaigns()
+            for campaign_id, voice_url, status_url, concurrency, pacing in running:
+                nap = min(nap, max(pacing, 0.05))
+                claimed = _claim_next(campaign_id, concurrency)
+                if claimed:
+                    _dial(client, from_number, voice_url, status_url, *claimed)
+            if running:
+                _finish_drained_campaigns()
+        except Exception as e:
+            print(f"Campaign worker error: {e}")
+        finally:
+            database.release_connection()
+        time.sleep(nap)
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def start_worker(client, from_number):
+    """Starts the dispatch thread once per process."""
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=run_worker, args=(client, from_number), name="campaign", daemon=True)
+            _worker.start()
+    return _worker
+
+
+def cancel_campaign(campaign_id):
+    """Stops dialing; calls already live finish normally."""
+    with database.transaction() as c:
+        c.execute("UPDATE campaigns SET state = 'cancelled' WHERE id = ? AND state = 'running'", (campaign_id,))
+        if not c.rowcount:
+            return False
+        c.execute('''
+            UPDATE campaign_calls SET status = 'canceled', updated_at = CURRENT_TIMESTAMP
+            WHERE campaign_id = ? AND status = 'queued'
+        ''', (campaign_id,))
+        return True
+
+
+def get_progress(campaign_id):
+    """Campaign settings plus call counts by status, or None if it doesn't exist."""
+    conn = database.get_connection()
+    row = conn.execute(f'SELECT {", ".join(CAMPAIGN_COLUMNS)} FROM campaigns WHERE id = ?', (campaign_id,)).fetchone()
+    if not row:
+        return None
+    progress = dict(zip(CAMPAIGN_COLUMNS, row))
+    counts = dict(conn.execute('''
+        SELECT status, count(*) FROM campaign_calls WHERE campaign_id = ? GROUP BY status
+    ''', (campaign_id,)).fetchall())
+    progress["calls"] = counts
+    progress["total"] = sum(counts.values())
+    progress["finished"] = sum(counts.get(s, 0) for s in FINAL_STATUSES)
+    progress["attempts"] = conn.execute(
+        'SELECT IFNULL(sum(attempts), 0) FROM campaign_calls WHERE campaign_id = ?', (campaign_id,)
+    ).fetchone()[0]
+    return progress
+
+
+def list_campaigns(limit=50):
+    rows = database.get_connection().execute(
+        f'SELECT {", ".join(CAMPAIGN_COLUMNS)} FROM campaigns ORDER BY id DESC LIMIT ?', (limit,)
+    ).fetchall()
+    return [dict(zip(CAMPAIGN_COLUMNS, row)) for row in rows]
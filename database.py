@@ -1,126 +1,970 @@
 import sqlite3
 import datetime
+import threading
+import queue
+import itertools
+import collections
+import re
+from contextlib import contextmanager
 
 DB_NAME = "conversations.db"
+# Session used by callers that don't identify themselves
+DEFAULT_SESSION = "default"
+
+# How long a writer waits on a locked database before giving up (milliseconds)
+BUSY_TIMEOUT_MS = 5000
+# Per-connection prepared statement cache size
+STATEMENT_CACHE_SIZE = 256
+# Idle connections kept around for reuse by new request threads
+POOL_SIZE = 8
+
+_local = threading.local()
+_pool = queue.LifoQueue(maxsize=POOL_SIZE)
+
+
+def _connect():
+    # isolation_level=None: we issue BEGIN/COMMIT ourselves in transaction()
+    conn = sqlite3.connect(
+        DB_NAME,
+        timeout=BUSY_TIMEOUT_MS / 1000,
+        isolation_level=None,
+        cached_statements=STATEMENT_CACHE_SIZE,
+        check_same_thread=False
+    )
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+def get_connection():
+    """
+    Returns the connection bound to the current thread.
+    Connections are long-lived: they come from a small pool and go back to it
+    in release_connection(), so request threads don't pay connect/PRAGMA cost.
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        try:
+            conn = _pool.get_nowait()
+        except queue.Empty:
+            conn = _connect()
+        _local.conn = conn
+        _local.depth = 0
+    return conn
+
+
+def release_connection(exc=None):
+    """Returns the current thread's connection to the pool (Flask teardown hook)."""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        return
+    _local.conn = None
+    if conn.in_transaction:
+        conn.execute('ROLLBACK')
+    _local.depth = 0
+    try:
+        _pool.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+
+def close_all():
+    """
+    Closes the current thread's connection and every pooled one, so the
+    next get_connection() opens DB_NAME afresh (e.g. after it changed).
+    """
+    conn = getattr(_local, 'conn', None)
+    _local.conn = None
+    _local.depth = 0
+    if conn is not None:
+        conn.close()
+    while True:
+        try:
+            _pool.get_nowait().close()
+        except queue.Empty:
+            return
+
+
+@contextmanager
+def transaction():
+    """
+    Groups writes into a single transaction.
+    Nested calls join the outermost transaction, so a request can wrap
+    several database functions and commit them together.
+    """
+    conn = get_connection()
+    if _local.depth == 0:
+        conn.execute('BEGIN IMMEDIATE')
+    _local.depth += 1
+    try:
+        yield conn.cursor()
+    except BaseException:
+        _local.depth -= 1
+        if _local.depth == 0:
+            conn.execute('ROLLBACK')
+        raise
+    else:
+        _local.depth -= 1
+        if _local.depth == 0:
+            conn.execute('COMMIT')
+
+
+def _query(sql, params=()):
+    return get_connection().execute(sql, params)
+
+
+def _table_exists(c, name):
+    c.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (name,))
+    return c.fetchone() is not None
+
+
+def _add_column(c, table, column, decl):
+    """Adds a column to an existing table if an older database lacks it."""
+    c.execute(f'PRAGMA table_info({table})')
+    if column not in [row[1] for row in c.fetchall()]:
+        c.execute(f'ALTER TABLE {table} ADD COLUMN {column} {decl}')
 
 
 def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS conversations (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_text TEXT NOT NULL,
-            ai_response TEXT NOT NULL,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
+    with transaction() as c:
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS conversations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_text TEXT NOT NULL,
+                ai_response TEXT NOT NULL,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        # Conversations are keyed by caller: CallSid, Telegram user id or browser session
+        _add_column(c, 'conversations', 'session_id', f"TEXT NOT NULL DEFAULT '{DEFAULT_SESSION}'")
+        c.execute('CREATE INDEX IF NOT EXISTS idx_conversations_session ON conversations (session_id, id)')
+        # Estimated prompt size sent to the model for each turn
+        _add_column(c, 'conversations', 'prompt_tokens', 'INTEGER')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS students (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                student_name TEXT NOT NULL,
+                parent_name TEXT NOT NULL,
+                class_info TEXT DEFAULT 'S8 ADS',
+                roll_number INTEGER,
+                academic_info TEXT,
+                disciplinary_info TEXT,
+                attendance_status TEXT DEFAULT 'Unknown'
+            )
+        ''')
+        # Every extracted circular is kept; passages are FTS-indexed for retrieval
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS documents (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                extracted_text TEXT NOT NULL,
+                source_name TEXT,
+                source_hash TEXT,
+                class_scope TEXT,
+                uploaded_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_documents_hash ON documents (source_hash)')
+        # Vision/OCR results per file content and prompt version, so a re-uploaded
+        # circular is never sent to Groq Vision twice
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS ocr_cache (
+                source_hash TEXT NOT NULL,
+                prompt_version TEXT NOT NULL,
+                extracted_text TEXT NOT NULL,
+                pages INTEGER,
+                hits INTEGER NOT NULL DEFAULT 0,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                last_used_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (source_hash, prompt_version)
+            )
+        ''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_ocr_cache_used ON ocr_cache (last_used_at)')
+        # Queued document analyses (see upload_queue.py); kept in the database so
+        # work accepted before a restart is still done after it
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS upload_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                filepath TEXT NOT NULL,
+                source_hash TEXT,
+                class_scope TEXT,
+                origin TEXT NOT NULL DEFAULT 'web',
+                status TEXT NOT NULL DEFAULT 'queued',
+                progress TEXT,
+                extracted_text TEXT,
+                error TEXT,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_upload_jobs_status ON upload_jobs (status, id)')
+        c.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS document_passages_fts USING fts5(
+                passage, document_id UNINDEXED, class_scope UNINDEXED,
+                tokenize='unicode61 remove_diacritics 2'
+            )
+        ''')
+        # Older databases kept only the latest circular in document_context
+        if _table_exists(c, 'document_context'):
+            c.execute('SELECT count(*) FROM documents')
+            if c.fetchone()[0] == 0:
+                c.execute('SELECT extracted_text, timestamp FROM document_context ORDER BY id')
+                for text, timestamp in c.fetchall():
+                    _insert_document(c, text, uploaded_at=timestamp)
+        # Roster lookups: upsert key on (class, roll number) plus name searches.
+        # The unique index also serves class_info-only filters.
+        c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_students_class_roll ON students (class_info, roll_number)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_students_parent ON students (parent_name)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_students_name ON students (student_name)')
+        # Lets a caller's phone number identify the parent directly
+        _add_column(c, 'students', 'parent_phone', 'TEXT')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_students_phone ON students (parent_phone)')
+        # Fuzzy (prefix) name search over the roster, kept in sync by triggers
+        fts_is_new = not _table_exists(c, 'students_fts')
+        c.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS students_fts USING fts5(
+                student_name, parent_name,
+                content='students', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+        ''')
+        c.execute('''
+            CREATE TRIGGER IF NOT EXISTS students_fts_insert AFTER INSERT ON students BEGIN
+                INSERT INTO students_fts (rowid, student_name, parent_name)
+                VALUES (new.id, new.student_name, new.parent_name);
+            END
+        ''')
+        c.execute('''
+            CREATE TRIGGER IF NOT EXISTS students_fts_delete AFTER DELETE ON students BEGIN
+                INSERT INTO students_fts (students_fts, rowid, student_name, parent_name)
+                VALUES ('delete', old.id, old.student_name, old.parent_name);
+            END
+        ''')
+        c.execute('''
+            CREATE TRIGGER IF NOT EXISTS students_fts_update AFTER UPDATE OF student_name, parent_name ON students BEGIN
+                INSERT INTO students_fts (students_fts, rowid, student_name, parent_name)
+                VALUES ('delete', old.id, old.student_name, old.parent_name);
+                INSERT INTO students_fts (rowid, student_name, parent_name)
+                VALUES (new.id, new.student_name, new.parent_name);
+            END
+        ''')
+        if fts_is_new:
+            _rebuild_students_fts(c)
+        # Who each conversation session has been identified as
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                student_id INTEGER,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        # Rolling summary of turns that no longer fit the prompt budget
+        _add_column(c, 'sessions', 'summary', "TEXT NOT NULL DEFAULT ''")
+        _add_column(c, 'sessions', 'summarized_through', 'INTEGER NOT NULL DEFAULT 0')
+        # Per-class RSVP counts, maintained by triggers on students so the
+        # report never has to scan the roster
+        c.execute('CREATE INDEX IF NOT EXISTS idx_students_status ON students (attendance_status)')
+        summary_is_new = not _table_exists(c, 'attendance_summary')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS attendance_summary (
+                class_info TEXT NOT NULL,
+                attendance_status TEXT NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (class_info, attendance_status)
+            )
+        ''')
+        c.execute('''
+            CREATE TRIGGER IF NOT EXISTS attendance_summary_insert AFTER INSERT ON students BEGIN
+                INSERT INTO attendance_summary (class_info, attendance_status, count)
+                VALUES (IFNULL(new.class_info, ''), IFNULL(new.attendance_status, 'Unknown'), 1)
+                ON CONFLICT (class_info, attendance_status) DO UPDATE SET count = count + 1;
+            END
+        ''')
+        c.execute('''
+            CREATE TRIGGER IF NOT EXISTS attendance_summary_delete AFTER DELETE ON students BEGIN
+                UPDATE attendance_summary SET count = count - 1
+                WHERE class_info = IFNULL(old.class_info, '') AND attendance_status = IFNULL(old.attendance_status, 'Unknown');
+            END
+        ''')
+        c.execute('''
+            CREATE TRIGGER IF NOT EXISTS attendance_summary_update AFTER UPDATE OF class_info, attendance_status ON students
+            WHEN old.class_info IS NOT new.class_info OR old.attendance_status IS NOT new.attendance_status BEGIN
+                UPDATE attendance_summary SET count = count - 1
+                WHERE class_info = IFNULL(old.class_info, '') AND attendance_status = IFNULL(old.attendance_status, 'Unknown');
+                INSERT INTO attendance_summary (class_info, attendance_status, count)
+                VALUES (IFNULL(new.class_info, ''), IFNULL(new.attendance_status, 'Unknown'), 1)
+                ON CONFLICT (class_info, attendance_status) DO UPDATE SET count = count + 1;
+            END
+        ''')
+        if summary_is_new:
+            _rebuild_attendance_summary(c)
+        # Change feed for live report updates (read by /report/stream)
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS attendance_log (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                student_id INTEGER NOT NULL,
+                attendance_status TEXT,
+                changed_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        c.execute('''
+            CREATE TRIGGER IF NOT EXISTS attendance_log_update AFTER UPDATE OF attendance_status ON students
+            WHEN old.attendance_status IS NOT new.attendance_status BEGIN
+                INSERT INTO attendance_log (student_id, attendance_status) VALUES (new.id, new.attendance_status);
+            END
+        ''')
+        # Single-row counter bumped by every write that changes the prompt context.
+        # Shared through the database file, so all Flask workers and the
+        # Telegram bot process see the same version.
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS data_version (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                version INTEGER NOT NULL
+            )
+        ''')
+        c.execute('INSERT OR IGNORE INTO data_version (id, version) VALUES (1, 0)')
+        # Per-call voice state, keyed by Twilio CallSid. Lives in the database so
+        # any worker process can answer the poll for a reply another one computed.
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS calls (
+                call_sid TEXT PRIMARY KEY,
+                parent_phone TEXT,
+                turn_count INTEGER NOT NULL DEFAULT 0,
+                silence_retries INTEGER NOT NULL DEFAULT 0,
+                state TEXT NOT NULL DEFAULT 'listening',
+                reply_text TEXT,
+                reply_audio TEXT,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        # Outbound call campaigns (see campaign.py): one row per campaign and
+        # one per parent to dial, advanced by the worker and Twilio status callbacks
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS campaigns (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL,
+                voice_url TEXT NOT NULL,
+                status_url TEXT NOT NULL,
+                concurrency INTEGER NOT NULL,
+                pacing_seconds REAL NOT NULL,
+                max_attempts INTEGER NOT NULL,
+                retry_delay_seconds INTEGER NOT NULL,
+                state TEXT NOT NULL DEFAULT 'running',
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS campaign_calls (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                campaign_id INTEGER NOT NULL,
+                student_id INTEGER NOT NULL,
+                phone TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'queued',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                call_sid TEXT,
+                last_error TEXT,
+                next_attempt_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE (campaign_id, student_id)
+            )
+        ''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_campaign_calls_status ON campaign_calls (campaign_id, status, next_attempt_at)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_campaign_calls_sid ON campaign_calls (call_sid)')
+        # Unix time of the campaign's last dial, claimed by whichever process dials next
+        _add_column(c, 'campaigns', 'last_dialed_at', 'REAL')
+    seed_data()
+
+def _rebuild_students_fts(c):
+    c.execute("INSERT INTO students_fts (students_fts) VALUES ('rebuild')")
+
+def _rebuild_attendance_summary(c):
+    c.execute('DELETE FROM attendance_summary')
     c.execute('''
-        CREATE TABLE IF NOT EXISTS students (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            student_name TEXT NOT NULL,
-            parent_name TEXT NOT NULL,
-            class_info TEXT DEFAULT 'S8 ADS',
-            roll_number INTEGER,
-            academic_info TEXT,
-            disciplinary_info TEXT,
-            attendance_status TEXT DEFAULT 'Unknown'
-        )
+        INSERT INTO attendance_summary (class_info, attendance_status, count)
+        SELECT IFNULL(class_info, ''), IFNULL(attendance_status, 'Unknown'), count(*)
+        FROM students GROUP BY 1, 2
     ''')
+
+def _bump_data_version(c):
+    c.execute('UPDATE data_version SET version = version + 1 WHERE id = 1')
+
+def get_data_version():
+    """Returns the current context data version (a cheap primary-key read)."""
+    return _query('SELECT version FROM data_version WHERE id = 1').fetchone()[0]
+
+# Passage size used for retrieval; a circular is split at sentence/line breaks
+PASSAGE_CHARS = 600
+# Default cap on retrieved circular text per turn
+DOC_CONTEXT_CHARS = 1500
+
+def _split_passages(text, size=PASSAGE_CHARS):
+    parts = re.split(r'(?<=[.!?।\n])\s+', text.strip())
+    passages, current = [], ""
+    for part in parts:
+        while len(part) > size:
+            passages.append(part[:size])
+            part = part[size:]
+        if current and len(current) + len(part) + 1 > size:
+            passages.append(current)
+            current = part
+        else:
+            current = f"{current} {part}" if current else part
+    if current:
+        passages.append(current)
+    return passages
+
+def _insert_document(c, text, source_name=None, source_hash=None, class_scope=None, uploaded_at=None):
     c.execute('''
-        CREATE TABLE IF NOT EXISTS document_context (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            extracted_text TEXT NOT NULL,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    conn.commit()
-    conn.close()
-    seed_data()
+        INSERT INTO documents (extracted_text, source_name, source_hash, class_scope, uploaded_at)
+        VALUES (?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+    ''', (text, source_name, source_hash, class_scope, uploaded_at))
+    document_id = c.lastrowid
+    c.executemany(
+        'INSERT INTO document_passages_fts (passage, document_id, class_scope) VALUES (?, ?, ?)',
+        [(passage, document_id, class_scope) for passage in _split_passages(text)]
+    )
+    return document_id
 
-def add_document_context(text):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    # Replace existing context with newest one
-    c.execute('DELETE FROM document_context')
-    c.execute('INSERT INTO document_context (extracted_text) VALUES (?)', (text,))
-    conn.commit()
-    conn.close()
+def add_document_context(text, source_name=None, source_hash=None, class_scope=None):
+    """
+    Stores a new circular alongside earlier ones. class_scope=None means all classes.
+    Re-uploading the same file for the same classes keeps the existing document.
+    """
+    with transaction() as c:
+        if source_hash:
+            c.execute('''
+                SELECT id FROM documents WHERE source_hash = ? AND class_scope IS ? AND extracted_text = ?
+            ''', (source_hash, class_scope, text))
+            row = c.fetchone()
+            if row:
+                return row[0]
+        document_id = _insert_document(c, text, source_name, source_hash, class_scope)
+        _bump_data_version(c)
+    return document_id
+
+# Cached vision results kept before the least recently used are evicted
+OCR_CACHE_MAX_ENTRIES = 500
+
+def get_cached_extract(source_hash, prompt_version):
+    """Returns the cached vision text for this file and prompt version, or None."""
+    with transaction() as c:
+        c.execute('''
+            UPDATE ocr_cache SET hits = hits + 1, last_used_at = CURRENT_TIMESTAMP
+            WHERE source_hash = ? AND prompt_version = ?
+        ''', (source_hash, prompt_version))
+        if not c.rowcount:
+            return None
+        c.execute('''
+            SELECT extracted_text FROM ocr_cache WHERE source_hash = ? AND prompt_version = ?
+        ''', (source_hash, prompt_version))
+        return c.fetchone()[0]
+
+def cache_extract(source_hash, prompt_version, extracted_text, pages=None, max_entries=OCR_CACHE_MAX_ENTRIES):
+    """Stores a vision result, evicting the least recently used entries beyond max_entries."""
+    with transaction() as c:
+        c.execute('''
+            INSERT INTO ocr_cache (source_hash, prompt_version, extracted_text, pages) VALUES (?, ?, ?, ?)
+            ON CONFLICT (source_hash, prompt_version) DO UPDATE SET
+                extracted_text = excluded.extracted_text, pages = excluded.pages,
+                last_used_at = CURRENT_TIMESTAMP
+        ''', (source_hash, prompt_version, extracted_text, pages))
+        c.execute('''
+            DELETE FROM ocr_cache WHERE rowid IN (
+                SELECT rowid FROM ocr_cache ORDER BY last_used_at DESC, rowid DESC LIMIT -1 OFFSET ?
+            )
+        ''', (max_entries,))
+
+def evict_ocr_cache(older_than_days=90):
+    """
+    Drops entries unused for older_than_days (this includes results from
+    older prompt versions, which are never hit again). Returns the number removed.
+    """
+    with transaction() as c:
+        c.execute("DELETE FROM ocr_cache WHERE last_used_at < datetime('now', ?)", (f'-{int(older_than_days)} days',))
+        return c.rowcount
+
+def get_ocr_cache_stats():
+    row = _query('''
+        SELECT count(*), IFNULL(sum(hits), 0), IFNULL(sum(length(extracted_text)), 0), count(DISTINCT prompt_version)
+        FROM ocr_cache
+    ''').fetchone()
+    return {"entries": row[0], "hits": row[1], "text_bytes": row[2], "prompt_versions": row[3],
+            "max_entries": OCR_CACHE_MAX_ENTRIES}
 
 def get_latest_document_context():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('SELECT extracted_text FROM document_context ORDER BY timestamp DESC LIMIT 1')
-    row = c.fetchone()
-    conn.close()
+    row = _query('SELECT extracted_text FROM documents ORDER BY id DESC LIMIT 1').fetchone()
     return row[0] if row else ""
 
+def get_latest_document_for_class(class_scope=None):
+    """Newest circular that applies to `class_scope` (school-wide ones always do)."""
+    row = _query('''
+        SELECT extracted_text FROM documents
+        WHERE class_scope IS NULL OR class_scope = ?
+        ORDER BY id DESC LIMIT 1
+    ''', (class_scope,)).fetchone()
+    return row[0] if row else ""
+
+def search_documents(query_text, k=3, max_chars=DOC_CONTEXT_CHARS, class_scope=None):
+    """
+    Returns the top-k circular passages relevant to `query_text`, newest
+    document first among equals, joined and capped at max_chars.
+    Passages scoped to another class are skipped.
+    """
+    query = _fts_query(query_text)
+    if not query:
+        return ""
+    rows = _query('''
+        SELECT f.passage, d.uploaded_at
+        FROM document_passages_fts f JOIN documents d ON d.id = f.document_id
+        WHERE document_passages_fts MATCH ?
+          AND (f.class_scope IS NULL OR f.class_scope = ?)
+        ORDER BY bm25(document_passages_fts), d.id DESC
+        LIMIT ?
+    ''', (query, class_scope, k)).fetchall()
+    excerpts, used = [], 0
+    for passage, uploaded_at in rows:
+        excerpt = f"- ({uploaded_at[:10]}) {passage}"
+        if used + len(excerpt) > max_chars:
+            excerpt = excerpt[:max_chars - used]
+        if not excerpt:
+            break
+        excerpts.append(excerpt)
+        used += len(excerpt)
+    return "\n".join(excerpts)
+
+def list_documents(limit=20, offset=0):
+    return _query('''
+        SELECT id, source_name, class_scope, uploaded_at, substr(extracted_text, 1, 200)
+        FROM documents ORDER BY id DESC LIMIT ? OFFSET ?
+    ''', (limit, offset)).fetchall()
+
 def seed_data():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    # Check if empty - simplistic check, might need to drop table manually if schema changed
-    c.execute('SELECT count(*) FROM students')
-    if c.fetchone()[0] == 0:
-        students = [
-            # Name, Parent, Class, Roll, Academic, Disciplinary
-            ('Abdullah', 'Basheer', 'S8 ADS', 1, 'Maths:PASS, Physics:PASS, Java:PASS, DS:FAIL', 'Ragging juniors'),
-            ('Raaniya', 'Rafeek', 'S8 ADS', 2, 'Maths:PASS, Physics:PASS, Java:PASS, DS:PASS', 'Disobeying hostel rules'),
-            ('Abu', 'Aimu', 'S8 ADS', 3, 'Maths:PASS, Physics:PASS, Java:PASS, DS:PASS', 'None')
-        ]
-        c.executemany('''
-            INSERT INTO students (student_name, parent_name, class_info, roll_number, academic_info, disciplinary_info) 
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', students)
-        conn.commit()
-    conn.close()
+    with transaction() as c:
+        # Check if empty - simplistic check, might need to drop table manually if schema changed
+        c.execute('SELECT count(*) FROM students')
+        if c.fetchone()[0] == 0:
+            students = [
+                # Name, Parent, Class, Roll, Academic, Disciplinary
+                ('Abdullah', 'Basheer', 'S8 ADS', 1, 'Maths:PASS, Physics:PASS, Java:PASS, DS:FAIL', 'Ragging juniors'),
+                ('Raaniya', 'Rafeek', 'S8 ADS', 2, 'Maths:PASS, Physics:PASS, Java:PASS, DS:PASS', 'Disobeying hostel rules'),
+                ('Abu', 'Aimu', 'S8 ADS', 3, 'Maths:PASS, Physics:PASS, Java:PASS, DS:PASS', 'None')
+            ]
+            c.executemany('''
+                INSERT INTO students (student_name, parent_name, class_info, roll_number, academic_info, disciplinary_info) 
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', students)
+            _bump_data_version(c)
+
+STUDENT_IMPORT_COLUMNS = (
+    'student_name', 'parent_name', 'class_info', 'roll_number', 'academic_info', 'disciplinary_info',
+    'parent_phone'
+)
+
+# Row triggers an import fires, which cost more than rebuilding their tables once
+BULK_DEFERRED_TRIGGERS = ('students_fts_insert', 'students_fts_update', 'attendance_summary_insert')
+
+def import_students(rows, batch_size=1000):
+    """
+    Bulk upserts student records keyed on (class_info, roll_number).
+    `rows` is any iterable of dicts with STUDENT_IMPORT_COLUMNS keys; it is
+    consumed in batches, so a generator over a large file is never held in
+    memory. Everything commits in one transaction. Attendance is left as is
+    for students that already exist. Returns the number of rows written.
+
+    Past the first batch, the name-search and attendance-summary triggers
+    are dropped for the rest of the import and their tables rebuilt at the
+    end, inside the same transaction.
+    """
+    rows = iter(rows)
+    total = 0
+    deferred = None
+    with transaction() as c:
+        while True:
+            batch = [tuple(row.get(col) for col in STUDENT_IMPORT_COLUMNS) for row in itertools.islice(rows, batch_size)]
+            if not batch:
+                break
+            if total and deferred is None:
+                placeholders = ", ".join("?" * len(BULK_DEFERRED_TRIGGERS))
+                c.execute(f"SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND name IN ({placeholders})",
+                          BULK_DEFERRED_TRIGGERS)
+                deferred = c.fetchall()
+                for name, _ in deferred:
+                    c.execute(f'DROP TRIGGER {name}')
+            c.executemany('''
+                INSERT INTO students (student_name, parent_name, class_info, roll_number, academic_info, disciplinary_info, parent_phone)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (class_info, roll_number) DO UPDATE SET
+                    student_name = excluded.student_name,
+                    parent_name = excluded.parent_name,
+                    academic_info = excluded.academic_info,
+                    disciplinary_info = excluded.disciplinary_info,
+                    parent_phone = COALESCE(excluded.parent_phone, students.parent_phone)
+            ''', batch)
+            total += len(batch)
+        if deferred is not None:
+            for _, sql in deferred:
+                c.execute(sql)
+            _rebuild_students_fts(c)
+            _rebuild_attendance_summary(c)
+        if total:
+            _bump_data_version(c)
+    return total
+
+def list_students(class_info=None, limit=100, offset=0):
+    """Returns one page of the roster, optionally for a single class."""
+    sql = 'SELECT id, student_name, parent_name, class_info, roll_number, attendance_status FROM students'
+    params = []
+    if class_info:
+        sql += ' WHERE class_info = ?'
+        params.append(class_info)
+    sql += ' ORDER BY class_info, roll_number LIMIT ? OFFSET ?'
+    params += [limit, offset]
+    return _query(sql, params).fetchall()
+
+ANNOUNCEMENTS = "\n\n[GLOBAL ANNOUNCEMENT]\n- PARENT MEETING: 25 January 2026. Notify ALL parents about this compulsory meeting."
+
+# Rosters up to this size are listed in full before the parent is identified
+NAME_INDEX_LIMIT = 200
 
 def get_student_context():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('SELECT student_name, parent_name, class_info, academic_info, disciplinary_info FROM students')
-    rows = c.fetchall()
-    conn.close()
+    """Full roster dump (for debugging; prompts use get_prompt_context)."""
+    rows = _query('SELECT student_name, parent_name, class_info, academic_info, disciplinary_info FROM students').fetchall()
     
-    context = "Class List (S8 ADS) - Student Records:\n"
+    lines = ["Class List (S8 ADS) - Student Records:\n"]
     for row in rows:
-        context += f"""
+        lines.append(f"""
         - Student: {row[0]} (Parent: {row[1]})
           - Academic: {row[3]}
           - Disciplinary Issues: {row[4]}
-        """
-    
-    announcements = "\n\n[GLOBAL ANNOUNCEMENT]\n- PARENT MEETING: 25 January 2026. Notify ALL parents about this compulsory meeting."
+        """)
+    lines.append(ANNOUNCEMENTS)
     
-    return context + announcements
-
-def add_conversation(user_text, ai_response):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('INSERT INTO conversations (user_text, ai_response) VALUES (?, ?)', (user_text, ai_response))
-    conn.commit()
-    conn.close()
-
-def get_conversations():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('SELECT * FROM conversations ORDER BY timestamp DESC')
-    rows = c.fetchall()
-    conn.close()
-    return rows
-
-def update_attendance(parent_name, status):
-    """Updates attendance status for a specific parent's student."""
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('UPDATE students SET attendance_status = ? WHERE parent_name = ?', (status, parent_name))
-    conn.commit()
-    conn.close()
-
-def get_attendance_report():
-    """Returns a list of all students and their meeting attendance status."""
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('SELECT student_name, parent_name, roll_number, attendance_status FROM students')
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    return "".join(lines)
+
+def normalize_phone(phone):
+    """Keeps the leading + and digits, so '+91 98470-12345' matches '+919847012345'."""
+    if not phone:
+        return None
+    phone = phone.strip()
+    digits = re.sub(r'\D', '', phone)
+    return ('+' + digits if phone.startswith('+') else digits) or None
+
+def _fts_query(text, prefix=True, max_terms=12):
+    """Turns free text into an FTS5 query: "abdul"* OR "basheer"* ..."""
+    words = [w for w in re.findall(r'\w+', text or '') if len(w) >= 3]
+    star = '*' if prefix else ''
+    return ' OR '.join(f'"{w}"{star}' for w in words[:max_terms])
+
+def search_students(text, limit=5, prefix=True):
+    """
+    Ranks students whose own or parent's name matches words in `text`.
+    prefix=True also matches partial names ("Abdul" -> Abdullah).
+    """
+    query = _fts_query(text, prefix)
+    if not query:
+        return []
+    return _query('''
+        SELECT s.id, s.student_name, s.parent_name, s.class_info
+        FROM students_fts JOIN students s ON s.id = students_fts.rowid
+        WHERE students_fts MATCH ?
+        ORDER BY bm25(students_fts)
+        LIMIT ?
+    ''', (query, limit)).fetchall()
+
+def find_student_by_parent(parent_name):
+    """Returns the student id for an exact parent name, or None if unknown/ambiguous."""
+    rows = _query('SELECT id FROM students WHERE parent_name = ? LIMIT 2', (parent_name,)).fetchall()
+    return rows[0][0] if len(rows) == 1 else None
+
+def find_student_by_phone(phone):
+    phone = normalize_phone(phone)
+    if not phone:
+        return None
+    rows = _query('SELECT id FROM students WHERE parent_phone = ? LIMIT 2', (phone,)).fetchall()
+    return rows[0][0] if len(rows) == 1 else None
+
+def get_session_student(session_id):
+    row = _query('SELECT student_id FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
+    return row[0] if row else None
+
+def set_session_student(session_id, student_id):
+    with transaction() as c:
+        c.execute('''
+            INSERT INTO sessions (session_id, student_id) VALUES (?, ?)
+            ON CONFLICT (session_id) DO UPDATE SET student_id = excluded.student_id, updated_at = CURRENT_TIMESTAMP
+        ''', (session_id, student_id))
+
+def get_student_record(student_id):
+    """Formats one student's full record for the prompt."""
+    row = _query('''
+        SELECT student_name, parent_name, class_info, roll_number, academic_info, disciplinary_info, attendance_status
+        FROM students WHERE id = ?
+    ''', (student_id,)).fetchone()
+    if not row:
+        return ""
+    return f"""Identified Parent: {row[1]}
+        - Student: {row[0]} (Class: {row[2]}, Roll No: {row[3]})
+          - Academic: {row[4]}
+          - Disciplinary Issues: {row[5]}
+          - Meeting Attendance: {row[6]}"""
+
+def get_student_class(student_id):
+    row = _query('SELECT class_info FROM students WHERE id = ?', (student_id,)).fetchone()
+    return row[0] if row else None
+
+def _student_count():
+    return _query('SELECT count(*) FROM students').fetchone()[0]
+
+def get_name_index(query_text=None, count=None):
+    """
+    Compact roster view used before the parent is identified.
+    Small rosters are listed in full as "Student (Parent)"; larger ones only
+    show the names matching what the caller just said.
+    """
+    if count is None:
+        count = _student_count()
+    if count <= NAME_INDEX_LIMIT:
+        rows = _query('SELECT student_name, parent_name FROM students ORDER BY class_info, roll_number').fetchall()
+        header = f"Parent not identified yet. Roster ({count} students), Student (Parent):"
+    else:
+        rows = [(r[1], r[2]) for r in search_students(query_text, limit=10)]
+        header = f"Parent not identified yet. {count} students on file; possible matches, Student (Parent):"
+        if not rows:
+            return f"Parent not identified yet. {count} students on file; ask for the parent's and child's name."
+    return header + "\n" + "\n".join(f"- {s} ({p})" for s, p in rows)
+
+_context_cache = collections.OrderedDict()
+_context_lock = threading.Lock()
+CONTEXT_CACHE_SIZE = 256
+
+def get_prompt_context(student_id=None, query_text=None):
+    """
+    Returns (cache_key, student_context, doc_context) for one turn.
+    With an identified student only that record and the announcements go in;
+    otherwise the compact name index. Results are cached per
+    (data version, student) and rebuilt only when the version moves.
+    cache_key is None when the context depends on the utterance.
+    """
+    version = get_data_version()
+    key = (version, student_id)
+    with _context_lock:
+        cached = _context_cache.get(key)
+        if cached:
+            _context_cache.move_to_end(key)
+            return (key,) + cached
+    # The newest circular (capped) stays in the prompt; older ones are retrieved per turn
+    class_scope = get_student_class(student_id) if student_id is not None else None
+    doc_context = get_latest_document_for_class(class_scope)[:DOC_CONTEXT_CHARS]
+    if student_id is not None:
+        student_context = get_student_record(student_id) + ANNOUNCEMENTS
+    else:
+        count = _student_count()
+        student_context = get_name_index(query_text, count) + ANNOUNCEMENTS
+        if count > NAME_INDEX_LIMIT:
+            # Depends on the utterance, so not cacheable
+            return None, student_context, doc_context
+    with _context_lock:
+        _context_cache[key] = (student_context, doc_context)
+        while len(_context_cache) > CONTEXT_CACHE_SIZE:
+            _context_cache.popitem(last=False)
+    return key, student_context, doc_context
+
+def add_conversation(user_text, ai_response, session_id=DEFAULT_SESSION, prompt_tokens=None):
+    with transaction() as c:
+        c.execute(
+            'INSERT INTO conversations (user_text, ai_response, session_id, prompt_tokens) VALUES (?, ?, ?, ?)',
+            (user_text, ai_response, session_id, prompt_tokens)
+        )
+
+def get_recent_turns(session_id=DEFAULT_SESSION, limit=10, after_id=0):
+    """
+    Returns the last `limit` turns of one session newer than `after_id`,
+    oldest first, as (id, user_text, ai_response) tuples. Served straight
+    from the (session_id, id) index, so cost doesn't grow with the table.
+    """
+    rows = _query(
+        '''SELECT id, user_text, ai_response FROM conversations
+           WHERE session_id = ? AND id > ? ORDER BY id DESC LIMIT ?''',
+        (session_id, after_id, limit)
+    ).fetchall()
+    return rows[::-1]
+
+def get_turns_between(session_id, after_id, before_id):
+    """Turns of one session with after_id < id < before_id, oldest first, as (id, user_text, ai_response)."""
+    return _query(
+        '''SELECT id, user_text, ai_response FROM conversations
+           WHERE session_id = ? AND id > ? AND id < ? ORDER BY id''',
+        (session_id, after_id, before_id)
+    ).fetchall()
+
+def get_session_summary(session_id):
+    """Returns (summary, id of the last turn folded into it)."""
+    row = _query('SELECT summary, summarized_through FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
+    return (row[0], row[1]) if row else ("", 0)
+
+def update_session_summary(session_id, summary, summarized_through):
+    with transaction() as c:
+        c.execute('''
+            INSERT INTO sessions (session_id, summary, summarized_through) VALUES (?, ?, ?)
+            ON CONFLICT (session_id) DO UPDATE SET
+                summary = excluded.summary,
+                summarized_through = excluded.summarized_through,
+                updated_at = CURRENT_TIMESTAMP
+        ''', (session_id, summary, summarized_through))
+
+def get_prompt_size_stats(limit=500):
+    """Average/max estimated prompt tokens over the most recent turns that recorded it."""
+    row = _query('''
+        SELECT count(*), avg(prompt_tokens), max(prompt_tokens) FROM (
+            SELECT prompt_tokens FROM conversations
+            WHERE prompt_tokens IS NOT NULL ORDER BY id DESC LIMIT ?
+        )
+    ''', (limit,)).fetchone()
+    return {"turns": row[0], "avg_prompt_tokens": round(row[1] or 0, 1), "max_prompt_tokens": row[2] or 0}
+
+CALL_COLUMNS = ('call_sid', 'parent_phone', 'turn_count', 'silence_retries', 'state',
+                'reply_text', 'reply_audio', 'turn_age_seconds')
+
+def get_call(call_sid):
+    """Returns the call's state as a dict, or None for a new call."""
+    row = _query(f'''
+        SELECT {", ".join(CALL_COLUMNS[:-1])}, strftime('%s', 'now') - strftime('%s', updated_at)
+        FROM calls WHERE call_sid = ?
+    ''', (call_sid,)).fetchone()
+    return dict(zip(CALL_COLUMNS, row)) if row else None
+
+def start_call(call_sid, parent_phone=None):
+    """Registers a call; returns False if it was already known."""
+    with transaction() as c:
+        c.execute('INSERT OR IGNORE INTO calls (call_sid, parent_phone) VALUES (?, ?)', (call_sid, parent_phone))
+        return c.rowcount == 1
+
+def record_call_silence(call_sid):
+    """Counts one unanswered prompt and returns the running count."""
+    with transaction() as c:
+        c.execute('''
+            UPDATE calls SET silence_retries = silence_retries + 1, updated_at = CURRENT_TIMESTAMP
+            WHERE call_sid = ?
+        ''', (call_sid,))
+        return c.execute('SELECT silence_retries FROM calls WHERE call_sid = ?', (call_sid,)).fetchone()[0]
+
+def begin_call_turn(call_sid):
+    """
+    Marks a reply as being computed. Returns the new turn number, which
+    finish_call_turn() needs, or None if a reply is already in progress.
+    """
+    with transaction() as c:
+        c.execute('''
+            UPDATE calls SET state = 'thinking', turn_count = turn_count + 1, silence_retries = 0,
+                reply_text = NULL, reply_audio = NULL, updated_at = CURRENT_TIMESTAMP
+            WHERE call_sid = ? AND state != 'thinking'
+        ''', (call_sid,))
+        if c.rowcount != 1:
+            return None
+        return c.execute('SELECT turn_count FROM calls WHERE call_sid = ?', (call_sid,)).fetchone()[0]
+
+def finish_call_turn(call_sid, turn, reply_text, reply_audio=None, failed=False):
+    """
+    Parks the reply for `turn`. Returns False if that turn is no longer the
+    one in progress (it timed out and the caller moved on); the late reply is dropped.
+    """
+    with transaction() as c:
+        c.execute('''
+            UPDATE calls SET state = ?, reply_text = ?, reply_audio = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE call_sid = ? AND turn_count = ? AND state = 'thinking'
+        ''', ('error' if failed else 'ready', reply_text, reply_audio, call_sid, turn))
+        return c.rowcount == 1
+
+def take_call_reply(call_sid):
+    """Hands out a finished reply once, returning the call to 'listening'. None while still thinking."""
+    with transaction() as c:
+        call = get_call(call_sid)
+        if not call or call['state'] not in ('ready', 'error'):
+            return None
+        c.execute('''
+            UPDATE calls SET state = 'listening', updated_at = CURRENT_TIMESTAMP WHERE call_sid = ?
+        ''', (call_sid,))
+        return call
+
+def prune_calls(older_than_days=1):
+    """Drops state for calls idle longer than older_than_days. Returns the number removed."""
+    with transaction() as c:
+        c.execute("DELETE FROM calls WHERE updated_at < datetime('now', ?)", (f'-{int(older_than_days)} days',))
+        return c.rowcount
+
+def update_attendance(parent_name, status, student_id=None):
+    """Updates attendance status for a specific parent's student (narrowed by id when known)."""
+    with transaction() as c:
+        if student_id is not None:
+            c.execute('UPDATE students SET attendance_status = ? WHERE id = ?', (status, student_id))
+        else:
+            c.execute('UPDATE students SET attendance_status = ? WHERE parent_name = ?', (status, parent_name))
+        _bump_data_version(c)
+
+ATTENDANCE_STATUSES = ('Confirmed', 'Declined', 'Unknown')
+
+def _report_filter(class_info=None, status=None, search=None):
+    clauses, params = [], []
+    if class_info:
+        clauses.append('class_info = ?')
+        params.append(class_info)
+    if status:
+        clauses.append('attendance_status = ?')
+        params.append(status)
+    if search:
+        # % and _ in the search text are literal, not wildcards
+        pattern = search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        clauses.append("(student_name LIKE ? ESCAPE '\\' OR parent_name LIKE ? ESCAPE '\\')")
+        params += [pattern, pattern]
+    return (' WHERE ' + ' AND '.join(clauses)) if clauses else '', params
+
+def get_attendance_report(class_info=None, status=None, search=None, limit=None, offset=0):
+    """
+    Returns students and their meeting attendance status as
+    (student_name, parent_name, roll_number, attendance_status, id, class_info),
+    optionally filtered and paginated.
+    """
+    where, params = _report_filter(class_info, status, search)
+    sql = 'SELECT student_name, parent_name, roll_number, attendance_status, id, class_info FROM students' + where
+    sql += ' ORDER BY class_info, roll_number'
+    if limit is not None:
+        sql += ' LIMIT ? OFFSET ?'
+        params += [limit, offset]
+    return _query(sql, params).fetchall()
+
+def count_attendance_report(class_info=None, status=None, search=None):
+    where, params = _report_filter(class_info, status, search)
+    return _query('SELECT count(*) FROM students' + where, params).fetchone()[0]
+
+def get_attendance_summary(class_info=None):
+    """Returns {status: count} from the materialized summary, for one class or all."""
+    summary = dict.fromkeys(ATTENDANCE_STATUSES, 0)
+    if class_info:
+        rows = _query(
+            'SELECT attendance_status, count FROM attendance_summary WHERE class_info = ?', (class_info,)
+        ).fetchall()
+    else:
+        rows = _query(
+            'SELECT attendance_status, sum(count) FROM attendance_summary GROUP BY attendance_status'
+        ).fetchall()
+    for status, count in rows:
+        summary[status] = summary.get(status, 0) + count
+    return summary
+
+def get_report_classes():
+    return [row[0] for row in _query(
+        'SELECT DISTINCT class_info FROM attendance_summary WHERE count > 0 ORDER BY class_info'
+    ).fetchall()]
+
+def get_last_attendance_change_id():
+    return _query('SELECT IFNULL(max(id), 0) FROM attendance_log').fetchone()[0]
+
+def get_attendance_changes(after_id, limit=200):
+    """Attendance changes logged after `after_id`, oldest first, with the current student row."""
+    return _query('''
+        SELECT l.id, s.id, s.student_name, s.parent_name, s.roll_number, l.attendance_status, s.class_info
+        FROM attendance_log l JOIN students s ON s.id = l.student_id
+        WHERE l.id > ?
+        ORDER BY l.id LIMIT ?
+    ''', (after_id, limit)).fetchall()
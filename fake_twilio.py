@@ -0,0 +1,101 @@
+"""
+Local stand-in for the Twilio Calls API, for exercising campaigns without
+placing real calls.
+
+It accepts POST /2010-04-01/Accounts/<sid>/Calls.json like Twilio, answers
+with a call SID, then plays out the call by posting status callbacks
+(initiated, ringing, then in-progress/completed or busy/no-answer/failed)
+to the StatusCallback URL.
+
+Usage:
+    python fake_twilio.py                      # listens on :5055
+    TWILIO_API_BASE_URL=http://localhost:5055 python app.py
+
+FAKE_TWILIO_OUTCOMES sets the outcome mix, e.g.
+"completed:0.7,busy:0.1,no-answer:0.15,failed:0.05".
+"""
+import os
+import random
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+
+from flask import Flask, jsonify, request
+
+app = Flask(__name__)
+
+OUTCOMES = [
+    (name, float(weight)) for name, weight in
+    (item.split(":") for item in os.getenv(
+        "FAKE_TWILIO_OUTCOMES", "completed:0.7,busy:0.1,no-answer:0.15,failed:0.05"
+    ).split(","))
+]
+# Seconds between simulated call events
+STEP_SECONDS = float(os.getenv("FAKE_TWILIO_STEP_SECONDS", "0.5"))
+CALL_SECONDS = float(os.getenv("FAKE_TWILIO_CALL_SECONDS", "2"))
+
+calls = {}
+calls_lock = threading.Lock()
+
+
+def _callback(url, call_sid, status, account_sid):
+    if not url:
+        return
+    data = urllib.parse.urlencode({"CallSid": call_sid, "CallStatus": status, "AccountSid": account_sid}).encode()
+    try:
+        urllib.request.urlopen(url, data=data, timeout=5).close()
+    except (urllib.error.URLError, OSError) as e:
+        print(f"Fake Twilio: callback to {url} failed: {e}")
+
+
+def _play_out(call_sid, account_sid, status_url):
+    outcome = random.choices([o[0] for o in OUTCOMES], weights=[o[1] for o in OUTCOMES])[0]
+    if outcome == 'failed':
+        steps = ['failed']
+    elif outcome == 'busy':
+        steps = ['initiated', 'busy']
+    else:
+        steps = ['initiated', 'ringing', 'in-progress', 'completed'] if outcome == 'completed' else ['initiated', 'ringing', outcome]
+    for status in steps:
+        time.sleep(CALL_SECONDS if status == 'completed' else STEP_SECONDS)
+        with calls_lock:
+            calls[call_sid]["status"] = status
+        _callback(status_url, call_sid, status, account_sid)
+
+
+@app.route('/2010-04-01/Accounts/<account_sid>/Calls.json', methods=['POST'])
+def create_call(account_sid):
+    to = request.form.get('To')
+    if not to or not request.form.get('From'):
+        return jsonify({"code": 21201, "message": "To and From are required", "status": 400}), 400
+    call_sid = "CA" + uuid.uuid4().hex
+    call = {
+        "sid": call_sid,
+        "account_sid": account_sid,
+        "to": to,
+        "from": request.form.get('From'),
+        "status": "queued",
+        "direction": "outbound-api",
+        "uri": f"/2010-04-01/Accounts/{account_sid}/Calls/{call_sid}.json",
+    }
+    with calls_lock:
+        calls[call_sid] = call
+    print(f"Fake Twilio: dialing {to} as {call_sid}")
+    threading.Thread(
+        target=_play_out, args=(call_sid, account_sid, request.form.get('StatusCallback')), daemon=True
+    ).start()
+    return jsonify(call), 201
+
+
+@app.route('/calls')
+def list_calls():
+    """All simulated calls, for checking what a campaign dialed."""
+    with calls_lock:
+        return jsonify(list(calls.values()))
+
+
+if __name__ == '__main__':
+    app.run(port=int(os.getenv("FAKE_TWILIO_PORT", "5055")), threaded=True)
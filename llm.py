@@ -0,0 +1,136 @@
+"""
+Gemini client setup shared by the Flask app and the Telegram bot.
+
+genai is configured once per process, and GenerativeModel objects are
+reused across turns, keyed by (model name, system prompt hash), with LRU
+eviction. For large system prompts Gemini context caching can be enabled
+so the static prompt is uploaded once and only the new turn is billed.
+"""
+import collections
+import datetime
+import hashlib
+import os
+import threading
+import time
+
+import google.generativeai as genai
+from dotenv import load_dotenv
+
+load_dotenv()
+
+GEMINI_MODEL = "gemini-2.0-flash-lite-preview-02-05"  # Lite for better quota
+MODEL_CACHE_SIZE = int(os.getenv("GEMINI_MODEL_CACHE_SIZE", "32"))
+
+# Context caching is opt-in: it needs a model version that supports it and a
+# prompt above Gemini's minimum cacheable size.
+CONTEXT_CACHE_ENABLED = os.getenv("GEMINI_CONTEXT_CACHE", "").lower() in ("1", "true", "yes")
+CONTEXT_CACHE_MIN_CHARS = int(os.getenv("GEMINI_CONTEXT_CACHE_MIN_CHARS", "16000"))
+CONTEXT_CACHE_TTL_MINUTES = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL_MINUTES", "60"))
+# Replaced or evicted cached content is deleted only after this long, since
+# a turn that fetched the model just before may still be using it
+RETIRE_GRACE_SECONDS = 120
+
+_configured = False
+_configure_lock = threading.Lock()
+
+# (model name, prompt hash) -> (model, cached_content or None, expires_at)
+_models = collections.OrderedDict()
+_models_lock = threading.Lock()
+# [(delete after, cached_content)] retired from _models, awaiting deletion
+_retired = []
+
+
+def configure():
+    """Configures genai once per process. Returns False if the key is missing."""
+    global _configured
+    if _configured:
+        return True
+    with _configure_lock:
+        if not _configured:
+            api_key = os.getenv("GEMINI_API_KEY")
+            if not api_key:
+                return False
+            genai.configure(api_key=api_key)
+            _configured = True
+    return True
+
+
+def _create_cached_model(model_name, system_prompt):
+    """Uploads the system prompt as cached content; returns (model, cache) or None."""
+    if not CONTEXT_CACHE_ENABLED or len(system_prompt) < CONTEXT_CACHE_MIN_CHARS:
+        return None
+    try:
+        cache = genai.caching.CachedContent.create(
+            model=f"models/{model_name}",
+            system_instruction=system_prompt,
+            ttl=datetime.timedelta(minutes=CONTEXT_CACHE_TTL_MINUTES)
+        )
+        return genai.GenerativeModel.from_cached_content(cached_content=cache), cache
+    except Exception as e:
+        # Unsupported model or prompt below the minimum: fall back to a plain model
+        print(f"Gemini context cache unavailable: {e}")
+        return None
+
+
+def _delete(cache):
+    try:
+        cache.delete()
+    except Exception:
+        pass
+
+
+def _retire(entry, now):
+    """Schedules an entry's cached content for deletion once in-flight turns are done with it (call under the lock)."""
+    _, cache, _ = entry
+    if cache is not None:
+        _retired.append((now + RETIRE_GRACE_SECONDS, cache))
+
+
+def _take_due(now):
+    """Removes and returns retired caches past their grace period (call under the lock)."""
+    due = [cache for delete_after, cache in _retired if delete_after <= now]
+    _retired[:] = [item for item in _retired if item[0] > now]
+    return due
+
+
+def get_model(system_prompt, model_name=GEMINI_MODEL):
+    """Returns a GenerativeModel for this system prompt, building it only on a cache miss."""
+    key = (model_name, hashlib.sha256(system_prompt.encode('utf-8')).hexdigest())
+    now = time.time()
+    with _models_lock:
+        entry = _models.get(key)
+        due = _take_due(now) if _retired else []
+        if entry and entry[2] > now:
+            _models.move_to_end(key)
+    for cache in due:
+        _delete(cache)
+    if entry and entry[2] > now:
+        return entry[0]
+
+    cached = _create_cached_model(model_name, system_prompt)
+    if cached:
+        # Rebuild a little before Gemini expires the cached content
+        entry = (cached[0], cached[1], now + CONTEXT_CACHE_TTL_MINUTES * 60 - 60)
+    else:
+        entry = (genai.GenerativeModel(model_name, system_instruction=system_prompt), None, float('inf'))
+
+    with _models_lock:
+        current = _models.get(key)
+        if current and current[2] > now:
+            # Another thread built this model meanwhile: keep theirs, drop ours
+            _models.move_to_end(key)
+            unused, model = entry[1], current[0]
+        else:
+            if current:
+                _retire(_models.pop(key), now)
+            _models[key] = entry
+            while len(_models) > MODEL_CACHE_SIZE:
+                _retire(_models.popitem(last=False)[1], now)
+            unused, model = None, entry[0]
+        due = _take_due(now)
+    # Nobody has seen the duplicate yet, so it can go right away
+    if unused is not None:
+        _delete(unused)
+    for cache in due:
+        _delete(cache)
+    return model
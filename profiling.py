@@ -0,0 +1,287 @@
+"""
+Per-request profiling and slow-turn capture.
+
+Entry points wrapped with @profiled (get_ai_response, process_file_monitor,
+generate_audio, transcribe_audio, the voice turns) are timed as a trace of
+named stages; a profiled function called inside another one's trace is
+recorded as a stage of it. Any trace longer than SLOW_TURN_SECONDS is
+written to PROFILE_DIR as Chrome trace-event JSON, which opens in
+chrome://tracing, ui.perfetto.dev or speedscope.
+
+Deeper profiling is opt-in, per request with the X-Profile header on Flask
+routes, or for every trace with PROFILE_MODE:
+  cprofile  cProfile of the thread driving the trace -> .prof
+            (snakeviz, python -m pstats)
+  sampling  stacks of all threads every PROFILE_SAMPLE_MS -> .folded
+            (speedscope, flamegraph.pl). Better for the async pipeline,
+            whose work hops between the event loop and worker threads.
+Only the newest PROFILE_KEEP files are kept.
+"""
+import contextlib
+import contextvars
+import cProfile
+import collections
+import functools
+import inspect
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_MODE = os.getenv("PROFILE_MODE", "").lower()
+SLOW_TURN_SECONDS = float(os.getenv("SLOW_TURN_SECONDS", "8"))
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "50"))
+PROFILE_SAMPLE_MS = float(os.getenv("PROFILE_SAMPLE_MS", "5"))
+PROFILE_HEADER = "X-Profile"
+MODES = ("cprofile", "sampling")
+
+_trace = contextvars.ContextVar("profiling_trace", default=None)
+_requested = contextvars.ContextVar("profiling_mode", default=None)
+# cProfile and the sampler are process-wide, so one profiled trace runs at a time
+_profiler_lock = threading.Lock()
+
+
+def parse_mode(value):
+    """Maps a header/env value to a mode in MODES, or None."""
+    value = (value or "").strip().lower()
+    if value in ("1", "true", "yes"):
+        return "sampling"
+    return value if value in MODES else None
+
+
+def request_mode(value):
+    """Sets the profiling mode for the current request (the X-Profile header value)."""
+    _requested.set(parse_mode(value))
+
+
+class Trace:
+    def __init__(self, name, mode):
+        self.name = name
+        self.mode = mode
+        self.id = uuid.uuid4().hex[:8]
+        self.wall_started = time.time()
+        self.started = time.perf_counter()
+        self.stages = []  # (name, start offset s, duration s, thread name)
+
+    def add(self, name, start, duration):
+        self.stages.append((name, start - self.started, duration, threading.current_thread().name))
+
+    def breakdown(self):
+        """Total seconds and call count per stage name, slowest first."""
+        totals = collections.defaultdict(lambda: [0.0, 0])
+        for name, _, duration, _ in self.stages:
+            totals[name][0] += duration
+            totals[name][1] += 1
+        return {name: {"seconds": round(total, 3), "calls": calls}
+                for name, (total, calls) in sorted(totals.items(), key=lambda item: -item[1][0])}
+
+
+class Sampler:
+    """Samples the stacks of every other thread into folded-stack counts."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.counts = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.counts[";".join(reversed(stack))] += 1
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            for stack, count in self.counts.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+def _dump_path(trace, extension):
+    stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(trace.wall_started))
+    return os.path.join(PROFILE_DIR, f"{stamp}-{trace.name}-{trace.id}{extension}")
+
+
+def _rotate():
+    """Deletes the oldest dumps beyond PROFILE_KEEP."""
+    entries = sorted(os.scandir(PROFILE_DIR), key=lambda entry: entry.stat().st_mtime, reverse=True)
+    for entry in entries[PROFILE_KEEP:]:
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+
+def _lanes(stages):
+    """
+    Assigns each stage a track within its thread so that stages on a track
+    nest properly (concurrent pages on the event loop overlap without nesting).
+    """
+    tracks = collections.defaultdict(list)  # thread -> one stack of open end times per track
+    order = sorted(range(len(stages)), key=lambda i: (stages[i][1], -stages[i][2]))
+    placed = [None] * len(stages)
+    for i in order:
+        _, start, duration, thread = stages[i]
+        end = start + duration
+        for lane, stack in enumerate(tracks[thread]):
+            while stack and stack[-1] <= start:
+                stack.pop()
+            if not stack or end <= stack[-1]:
+                stack.append(end)
+                break
+        else:
+            tracks[thread].append([end])
+            lane = len(tracks[thread]) - 1
+        placed[i] = thread if lane == 0 else f"{thread} #{lane + 1}"
+    return placed
+
+
+def _write_trace(trace, duration):
+    events = [
+        {"name": name, "ph": "X", "pid": 1, "tid": lane,
+         "ts": round(start * 1e6), "dur": max(1, round(stage_duration * 1e6))}
+        for (name, start, stage_duration, _), lane in zip(trace.stages, _lanes(trace.stages))
+    ]
+    path = _dump_path(trace, ".json")
+    with open(path, "w") as f:
+        json.dump({
+            "traceEvents": events,
+            "otherData": {
+                "name": trace.name,
+                "started_at": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(trace.wall_started)),
+                "seconds": round(duration, 3),
+                "mode": trace.mode,
+                "stages": trace.breakdown(),
+            },
+        }, f, indent=1)
+    return path
+
+
+def _finish(trace, duration, profiler):
+    slow = duration >= SLOW_TURN_SECONDS
+    if not slow and not trace.mode:
+        return
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = _write_trace(trace, duration)
+        if isinstance(profiler, cProfile.Profile):
+            profiler.dump_stats(_dump_path(trace, ".prof"))
+        elif isinstance(profiler, Sampler):
+            profiler.dump(_dump_path(trace, ".folded"))
+        _rotate()
+    except OSError as e:
+        print(f"Profiling: could not write {trace.name} dump: {e}")
+        return
+    stages = ", ".join(f"{name} {info['seconds']:.2f}s"
+                       for name, info in list(trace.breakdown().items())[:6] if name != trace.name)
+    label = "Slow" if slow else "Profiled"
+    print(f"{label} {trace.name}: {duration:.2f}s ({stages}) -> {path}")
+
+
+def _start_profiler(mode):
+    if not mode or not _profiler_lock.acquire(blocking=False):
+        return None
+    try:
+        if mode == "cprofile":
+            profiler = cProfile.Profile()
+            profiler.enable()
+        else:
+            profiler = Sampler(PROFILE_SAMPLE_MS / 1000)
+            profiler.start()
+        return profiler
+    except Exception as e:
+        _profiler_lock.release()
+        print(f"Profiling: could not start {mode}: {e}")
+        return None
+
+
+def _stop_profiler(profiler):
+    if profiler is None:
+        return
+    try:
+        if isinstance(profiler, cProfile.Profile):
+            profiler.disable()
+        else:
+            profiler.stop()
+    finally:
+        _profiler_lock.release()
+
+
+@contextlib.contextmanager
+def span(name):
+    """
+    Times a block as a stage of the current trace, or starts a new trace
+    (profiled if requested) when there is none.
+    """
+    start = time.perf_counter()
+    trace = _trace.get()
+    if trace is not None:
+        try:
+            yield trace
+        finally:
+            trace.add(name, start, time.perf_counter() - start)
+        return
+
+    trace = Trace(name, _requested.get() or parse_mode(PROFILE_MODE))
+    token = _trace.set(trace)
+    profiler = _start_profiler(trace.mode)
+    try:
+        yield trace
+    finally:
+        _stop_profiler(profiler)
+        _trace.reset(token)
+        duration = time.perf_counter() - start
+        trace.add(name, start, duration)
+        _finish(trace, duration, profiler)
+
+
+def profiled(name):
+    """Decorator form of span() for sync and async functions."""
+    def decorate(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def list_dumps(limit=50):
+    """Newest dumps first, for the admin endpoint."""
+    try:
+        entries = sorted(os.scandir(PROFILE_DIR), key=lambda entry: entry.stat().st_mtime, reverse=True)
+    except FileNotFoundError:
+        return []
+    return [{"file": entry.name, "bytes": entry.stat().st_size,
+             "modified": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry.stat().st_mtime))}
+            for entry in entries[:limit]]
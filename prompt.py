@@ -0,0 +1,151 @@
+"""
+Token-budgeted prompt assembly.
+
+The system prompt, the new message and as much recent history as fits go
+into PROMPT_TOKEN_BUDGET. Turns that fall out of the window are folded
+into a rolling per-session summary, so early facts (who is calling, what
+they already agreed to) survive long calls without resending every turn.
+
+The summary pins the session's opening turns (where the parent says who
+they are and which child they're asking about) and turns carrying numbers
+(dates, times, marks). When it outgrows SUMMARY_TOKEN_BUDGET the middle
+lines are compressed first; lines are only dropped once compressing is
+not enough, unpinned ones first.
+"""
+import os
+import re
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "4000"))
+SUMMARY_TOKEN_BUDGET = int(os.getenv("SUMMARY_TOKEN_BUDGET", "800"))
+# Upper bound on turns read from the database per prompt
+HISTORY_MAX_TURNS = 20
+# Characters kept from each side of a turn when it is folded into the summary
+SUMMARY_LINE_CHARS = 120
+# Successively shorter clips applied to older lines when the summary is over budget
+COMPRESSED_LINE_CHARS = (60, 30)
+# The first folded turns identify the caller and the child; they're never dropped
+IDENTITY_TURNS = 2
+# The newest summary lines are compressed last
+RECENT_SUMMARY_LINES = 2
+PINNED = "* "
+UNPINNED = "- "
+FACT_PATTERN = re.compile(r'[0-9൦-൯]')
+ADVISOR_SEP = " | Advisor: "
+
+
+def estimate_tokens(text):
+    """
+    Cheap token estimate without calling the tokenizer: about 4 characters
+    per token for Latin text, 2 for Malayalam and other non-ASCII scripts.
+    """
+    if not text:
+        return 0
+    non_ascii = sum(1 for ch in text if ord(ch) > 127)
+    return (len(text) - non_ascii) // 4 + non_ascii // 2 + 1
+
+
+def turn_tokens(user_text, ai_response):
+    return estimate_tokens(user_text) + estimate_tokens(ai_response) + 8
+
+
+def _clip(text, limit=SUMMARY_LINE_CHARS):
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+
+def _summary_line(marker, user_text, ai_response, width):
+    return f"{marker}Parent: {_clip(user_text, width)}{ADVISOR_SEP}{_clip(ai_response, width)}"
+
+
+def _compress(line, width):
+    """Re-clips both sides of a summary line to width characters."""
+    marker, body = line[:2], line[2:]
+    user_text, sep, ai_response = body.partition(ADVISOR_SEP)
+    if not sep:
+        return marker + _clip(body, width)
+    return _summary_line(marker, user_text.removeprefix("Parent: "), ai_response, width)
+
+
+def _over_budget(lines):
+    return estimate_tokens("\n".join(lines)) > SUMMARY_TOKEN_BUDGET
+
+
+def _shrink(lines):
+    """
+    Brings the summary under budget: compresses older unpinned lines, then
+    pinned fact lines, and only then drops lines (oldest unpinned first,
+    then fact lines). The identity lines are never shortened or dropped.
+    """
+    identity = [i for i, line in enumerate(lines) if line.startswith(PINNED)][:IDENTITY_TURNS]
+    for pinned in (False, True):
+        last = len(lines) if pinned else len(lines) - RECENT_SUMMARY_LINES
+        for width in COMPRESSED_LINE_CHARS:
+            for i in range(last):
+                if not _over_budget(lines):
+                    return lines
+                if lines[i].startswith(PINNED) == pinned and i not in identity:
+                    lines[i] = _compress(lines[i], width)
+    while _over_budget(lines):
+        unpinned = [i for i, line in enumerate(lines) if not line.startswith(PINNED)]
+        facts = [i for i, line in enumerate(lines) if line.startswith(PINNED)][IDENTITY_TURNS:]
+        droppable = unpinned or facts
+        if not droppable:
+            break
+        del lines[droppable[0]]
+    return lines
+
+
+def fold_into_summary(summary, turns):
+    """
+    Appends one condensed line per dropped turn to the summary and keeps it
+    under SUMMARY_TOKEN_BUDGET (see _shrink). The session's first
+    IDENTITY_TURNS turns and turns mentioning numbers are pinned.
+    Extractive on purpose: no extra model call on the hot path.
+    """
+    lines = [line for line in summary.split("\n") if line]
+    for _, user_text, ai_response in turns:
+        pinned = len(lines) < IDENTITY_TURNS or FACT_PATTERN.search(user_text)
+        lines.append(_summary_line(PINNED if pinned else UNPINNED, user_text, ai_response, SUMMARY_LINE_CHARS))
+    return "\n".join(_shrink(lines))
+
+
+def fit_history(turns, system_prompt, message, summary="", budget=PROMPT_TOKEN_BUDGET):
+    """
+    Splits turns (oldest first) into (kept, dropped): kept is the newest
+    run that fits in what the budget leaves after the system prompt,
+    message and summary; dropped are the older turns before it.
+    """
+    remaining = budget - estimate_tokens(system_prompt) - estimate_tokens(message) - estimate_tokens(summary)
+    kept_from = len(turns)
+    for i in range(len(turns) - 1, -1, -1):
+        cost = turn_tokens(turns[i][1], turns[i][2])
+        if cost > remaining:
+            break
+        remaining -= cost
+        kept_from = i
+    return turns[kept_from:], turns[:kept_from]
+
+
+def budget_history(turns, system_prompt, message, summary):
+    """
+    Fits turns (id, user_text, ai_response) into the budget, folding the
+    dropped ones into the summary. Folding grows the summary, so it refits
+    until nothing more has to go. Returns (kept, summary, last folded id or None).
+    """
+    folded_through = None
+    while True:
+        turns, dropped = fit_history(turns, system_prompt, message, summary)
+        if not dropped:
+            return turns, summary, folded_through
+        summary = fold_into_summary(summary, dropped)
+        folded_through = dropped[-1][0]
+
+
+def with_summary(message, summary):
+    if not summary:
+        return message
+    return f"[EARLIER IN THIS CONVERSATION]\n{summary}\n\n{message}"
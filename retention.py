@@ -0,0 +1,204 @@
+"""
+Conversation log retention.
+
+Turns older than the retention window are moved out of the hot
+`conversations` table into gzip JSON Lines files, one per month
+(archive/conversations-2026-01.jsonl.gz), and the database is compacted
+with incremental vacuum. The archive stays searchable for audits.
+
+Usage:
+    python retention.py archive [--days 30]
+    python retention.py vacuum
+    python retention.py stats
+    python retention.py search --session call:CA123 --month 2026-01
+"""
+import argparse
+import glob
+import gzip
+import json
+import os
+import threading
+import time
+
+from dotenv import load_dotenv
+
+import database
+import upload_queue
+
+load_dotenv()
+
+ARCHIVE_DIR = os.getenv("CONVERSATION_ARCHIVE_DIR", "archive")
+RETENTION_DAYS = int(os.getenv("CONVERSATION_RETENTION_DAYS", "30"))
+# Pages released per incremental vacuum step (0 = everything free)
+VACUUM_PAGES = 0
+
+ARCHIVE_COLUMNS = ('id', 'session_id', 'user_text', 'ai_response', 'timestamp')
+
+_archive_lock = threading.Lock()
+
+
+def _archive_path(month):
+    return os.path.join(ARCHIVE_DIR, f"conversations-{month}.jsonl.gz")
+
+
+def archive_conversations(older_than_days=RETENTION_DAYS, batch_size=5000):
+    """
+    Moves turns older than `older_than_days` into monthly gzip archives.
+    Each batch is read and written (and fsynced) outside any transaction;
+    only deleting its ids takes the write lock, so chat turns aren't held up
+    by compression or disk flushes. A crash, or a run in another process,
+    between the two can archive a row twice; search_archive() skips repeats.
+    Returns the number of turns archived.
+    """
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    total = 0
+    with _archive_lock:
+        while True:
+            # ids grow with time, so walking the primary key finds the oldest rows without a timestamp index
+            rows = database.get_connection().execute(f'''
+                SELECT {", ".join(ARCHIVE_COLUMNS)} FROM conversations
+                WHERE timestamp < datetime('now', ?)
+                ORDER BY id LIMIT ?
+            ''', (f'-{older_than_days} days', batch_size)).fetchall()
+            if not rows:
+                break
+
+            by_month = {}
+            for row in rows:
+                by_month.setdefault(row[4][:7], []).append(dict(zip(ARCHIVE_COLUMNS, row)))
+            for month, records in by_month.items():
+                # Append mode adds a new gzip member; gzip.open reads them back as one stream
+                with gzip.open(_archive_path(month), 'at', encoding='utf-8') as f:
+                    for record in records:
+                        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+
+            # Rows are only deleted once they are safely on disk
+            with database.transaction() as c:
+                c.executemany('DELETE FROM conversations WHERE id = ?', [(row[0],) for row in rows])
+            total += len(rows)
+            if len(rows) < batch_size:
+                break
+    return total
+
+
+def vacuum(pages=VACUUM_PAGES):
+    """
+    Returns free pages to the filesystem. The first run switches the
+    database to incremental auto-vacuum, which needs one full VACUUM.
+    """
+    conn = database.get_connection()
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+    else:
+        conn.execute(f'PRAGMA incremental_vacuum({int(pages)})').fetchall()
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+
+def run_maintenance(older_than_days=RETENTION_DAYS):
+    archived = archive_conversations(older_than_days)
+    # Voice call state is only needed while the call is live
+    database.prune_calls()
+    # Vision results nobody has re-uploaded in a while
+    database.evict_ocr_cache()
+    upload_queue.prune_jobs()
+    vacuum()
+    print(f"Retention: archived {archived} turns older than {older_than_days} days")
+    return archived
+
+
+def _file_size(path):
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def get_storage_stats():
+    """Database and archive sizes, for dashboards and /admin/storage."""
+    conn = database.get_connection()
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+    freelist = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    hot_rows, oldest = conn.execute('SELECT count(*), min(timestamp) FROM conversations').fetchone()
+
+    archives = sorted(glob.glob(os.path.join(ARCHIVE_DIR, "conversations-*.jsonl.gz")))
+    return {
+        "db_bytes": _file_size(database.DB_NAME),
+        "wal_bytes": _file_size(database.DB_NAME + "-wal"),
+        "page_size": page_size,
+        "page_count": page_count,
+        "free_pages": freelist,
+        "auto_vacuum": conn.execute('PRAGMA auto_vacuum').fetchone()[0],
+        "hot_conversations": hot_rows,
+        "oldest_hot_turn": oldest,
+        "retention_days": RETENTION_DAYS,
+        "archive_files": len(archives),
+        "archive_bytes": sum(_file_size(path) for path in archives),
+        "archive_months": [os.path.basename(path)[14:21] for path in archives],
+    }
+
+
+def search_archive(session_id=None, text=None, month=None, limit=100):
+    """Scans archived turns (optionally one month) for a session and/or substring."""
+    pattern = _archive_path(month) if month else os.path.join(ARCHIVE_DIR, "conversations-*.jsonl.gz")
+    results = []
+    seen = set()
+    for path in sorted(glob.glob(pattern)):
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                record = json.loads(line)
+                # A turn can be archived twice (see archive_conversations)
+                if record['id'] in seen:
+                    continue
+                seen.add(record['id'])
+                if session_id and record['session_id'] != session_id:
+                    continue
+                if text and text not in record['user_text'] and text not in record['ai_response']:
+                    continue
+                results.append(record)
+                if len(results) >= limit:
+                    return results
+    return results
+
+
+def start_scheduler(interval_hours, older_than_days=RETENTION_DAYS):
+    """Runs archive + vacuum every `interval_hours` on a daemon thread."""
+    def loop():
+        while True:
+            try:
+                run_maintenance(older_than_days)
+            except Exception as e:
+                print(f"Retention Error: {e}")
+            finally:
+                database.release_connection()
+            time.sleep(interval_hours * 3600)
+
+    thread = threading.Thread(target=loop, name="retention", daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Archive, compact and inspect the conversation log.")
+    sub = parser.add_subparsers(dest='command', required=True)
+    archive_cmd = sub.add_parser('archive', help="Move old turns to the archive, then vacuum")
+    archive_cmd.add_argument('--days', type=int, default=RETENTION_DAYS)
+    sub.add_parser('vacuum', help="Compact the database")
+    sub.add_parser('stats', help="Print size statistics")
+    search_cmd = sub.add_parser('search', help="Search archived turns")
+    search_cmd.add_argument('--session')
+    search_cmd.add_argument('--text')
+    search_cmd.add_argument('--month', help="YYYY-MM")
+    search_cmd.add_argument('--limit', type=int, default=100)
+    args = parser.parse_args()
+
+    database.init_db()
+    if args.command == 'archive':
+        run_maintenance(args.days)
+    elif args.command == 'vacuum':
+        vacuum()
+    elif args.command == 'stats':
+        print(json.dumps(get_storage_stats(), indent=2))
+    else:
+        for record in search_archive(args.session, args.text, args.month, args.limit):
+            print(json.dumps(record, ensure_ascii=False))
@@ -0,0 +1,140 @@
+"""
+Streaming roster import.
+
+Reads student rows from CSV, JSON Lines or a JSON array one record at a time
+and feeds them to database.import_students in batches.
+
+Usage:
+    python roster.py students.csv
+    python roster.py department.jsonl --batch-size 5000
+"""
+import argparse
+import csv
+import json
+import os
+import time
+
+import database
+
+REQUIRED_COLUMNS = ('student_name', 'parent_name', 'roll_number')
+DEFAULT_CLASS = 'S8 ADS'
+
+
+def detect_format(filename):
+    ext = filename.lower().rsplit('.', 1)[-1]
+    if ext in ('csv', 'json', 'jsonl'):
+        return ext
+    if ext == 'ndjson':
+        return 'jsonl'
+    raise ValueError(f"Unsupported roster format: .{ext} (use CSV, JSON or JSONL)")
+
+
+def _iter_json_array(fp, chunk_size=65536):
+    """Yields the objects of a top-level JSON array without reading the whole file."""
+    decoder = json.JSONDecoder()
+    buf = ""
+    started = False
+    eof = False
+    while True:
+        buf = buf.lstrip(" \t\r\n,")
+        if not started:
+            if buf.startswith("["):
+                buf = buf[1:]
+                started = True
+                continue
+            if buf:
+                raise ValueError("JSON roster must be an array of objects")
+        elif buf.startswith("]"):
+            return
+        elif buf:
+            try:
+                obj, end = decoder.raw_decode(buf)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            else:
+                yield obj
+                buf = buf[end:]
+                continue
+        if eof:
+            if started or buf:
+                raise ValueError("Truncated JSON roster")
+            return
+        chunk = fp.read(chunk_size)
+        if not chunk:
+            eof = True
+        buf += chunk
+
+
+def iter_raw_rows(fp, fmt):
+    """Yields raw records; malformed input raises ValueError naming the line."""
+    if fmt == 'csv':
+        reader = csv.DictReader(fp)
+        try:
+            yield from reader
+        except csv.Error as e:
+            raise ValueError(f"Malformed CSV after line {reader.line_num}: {e}") from e
+    elif fmt == 'jsonl':
+        for line_num, line in enumerate(fp, 1):
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError as e:
+                    raise ValueError(f"Invalid JSON at line {line_num}: {e}") from e
+    elif fmt == 'json':
+        yield from _iter_json_array(fp)
+    else:
+        raise ValueError(f"Unsupported roster format: {fmt}")
+
+
+def normalize_row(raw):
+    """Maps one raw record onto the students columns, or returns None if unusable."""
+    if not isinstance(raw, dict):
+        return None
+    row = {col: (str(raw[col]).strip() if raw.get(col) not in (None, "") else None)
+           for col in database.STUDENT_IMPORT_COLUMNS}
+    if any(not row[col] for col in REQUIRED_COLUMNS):
+        return None
+    try:
+        row['roll_number'] = int(row['roll_number'])
+    except ValueError:
+        return None
+    row['class_info'] = row['class_info'] or DEFAULT_CLASS
+    row['disciplinary_info'] = row['disciplinary_info'] or 'None'
+    row['parent_phone'] = database.normalize_phone(row['parent_phone'])
+    return row
+
+
+def import_file(fp, fmt, batch_size=1000):
+    """
+    Streams a roster file object into the students table.
+    Returns (imported, skipped).
+    """
+    stats = {'skipped': 0}
+
+    def rows():
+        for raw in iter_raw_rows(fp, fmt):
+            row = normalize_row(raw)
+            if row is None:
+                stats['skipped'] += 1
+                continue
+            yield row
+
+    imported = database.import_students(rows(), batch_size=batch_size)
+    return imported, stats['skipped']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Bulk import students (upsert on class + roll number).")
+    parser.add_argument('path', help="CSV, JSON or JSONL roster file")
+    parser.add_argument('--format', choices=['csv', 'json', 'jsonl'], help="Override format detection")
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    database.init_db()
+    fmt = args.format or detect_format(args.path)
+    start = time.time()
+    with open(args.path, newline='', encoding='utf-8') as fp:
+        imported, skipped = import_file(fp, fmt, args.batch_size)
+    elapsed = time.time() - start
+    print(f"Imported {imported} students ({skipped} skipped) from {os.path.basename(args.path)} in {elapsed:.1f}s")
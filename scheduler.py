@@ -0,0 +1,217 @@
+"""
+Outbound request scheduler for LLM, vision and speech-to-text calls.
+
+Every provider has a token bucket sized to our quota. Calls reserve a slot
+and wait for it (up to a deadline) instead of firing straight into a 429.
+Rate-limit errors that still happen are retried with exponential backoff,
+and call_with_failover_async() moves on to the next provider when one is
+saturated, e.g. Gemini chat -> Groq chat.
+
+Quotas are configured per provider in requests per minute:
+    RATE_LIMIT_GEMINI_RPM, RATE_LIMIT_GROQ_CHAT_RPM,
+    RATE_LIMIT_GROQ_VISION_RPM, RATE_LIMIT_GROQ_STT_RPM
+"""
+import asyncio
+import os
+import random
+import threading
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Requests per minute when no env override is set (free-tier quotas)
+DEFAULT_RPM = {
+    "gemini": 30,
+    "groq_chat": 30,
+    "groq_vision": 15,
+    "groq_stt": 20,
+}
+# How long a request may wait in the queue plus retries before giving up
+DEFAULT_DEADLINE_SECONDS = float(os.getenv("SCHEDULER_DEADLINE_SECONDS", "60"))
+MAX_RETRIES = int(os.getenv("SCHEDULER_MAX_RETRIES", "3"))
+BACKOFF_BASE_SECONDS = 1.0
+# A provider whose queue is longer than this is skipped when a fallback exists
+FAILOVER_WAIT_SECONDS = float(os.getenv("SCHEDULER_FAILOVER_WAIT_SECONDS", "5"))
+
+
+class RateLimited(Exception):
+    """Raised when a call can't be scheduled or retried before its deadline."""
+
+    def __init__(self, provider, detail="queue deadline exceeded"):
+        super().__init__(f"Rate limited (429): {provider} {detail}")
+        self.provider = provider
+
+
+class TokenBucket:
+    """
+    Token bucket that hands out reservations: tokens may go negative, and
+    each caller gets the delay until its own slot, so waiters are served
+    in arrival order.
+    """
+
+    def __init__(self, rate_per_minute, burst=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(burst or max(1, rate_per_minute // 6))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, max_wait=None):
+        """
+        Takes one token and returns the seconds to wait before using it,
+        or None (taking nothing) if that would exceed max_wait.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+            if max_wait is not None and wait > max_wait:
+                return None
+            self.tokens -= 1
+            return wait
+
+    def expected_wait(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def penalize(self, seconds):
+        """Drains the bucket after a 429 so other callers back off too."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def get_bucket(provider):
+    with _buckets_lock:
+        bucket = _buckets.get(provider)
+        if bucket is None:
+            rpm = float(os.getenv(f"RATE_LIMIT_{provider.upper()}_RPM", DEFAULT_RPM.get(provider, 30)))
+            bucket = _buckets[provider] = TokenBucket(rpm)
+        return bucket
+
+
+def is_rate_limit_error(e):
+    if getattr(e, "status_code", None) == 429 or getattr(e, "code", None) == 429:
+        return True
+    if type(e).__name__ in ("RateLimitError", "ResourceExhausted", "TooManyRequests"):
+        return True
+    text = str(e)
+    return "429" in text or "Resource has been exhausted" in text or "rate limit" in text.lower()
+
+
+def _retry_after(e):
+    response = getattr(e, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def _backoff(attempt, e):
+    delay = _retry_after(e)
+    if delay is None:
+        delay = BACKOFF_BASE_SECONDS * (2 ** attempt)
+    return delay + random.uniform(0, delay / 4)
+
+
+def _deadline(deadline, timeout):
+    if deadline is not None:
+        return deadline
+    return time.monotonic() + (DEFAULT_DEADLINE_SECONDS if timeout is None else timeout)
+
+
+def acquire(provider, deadline=None, timeout=None):
+    """Blocks until `provider` has capacity (for calls that can't be retried, like streams)."""
+    deadline = _deadline(deadline, timeout)
+    wait = get_bucket(provider).reserve(max_wait=deadline - time.monotonic())
+    if wait is None:
+        raise RateLimited(provider)
+    time.sleep(wait)
+
+
+async def acquire_async(provider, deadline=None, timeout=None):
+    deadline = _deadline(deadline, timeout)
+    wait = get_bucket(provider).reserve(max_wait=deadline - time.monotonic())
+    if wait is None:
+        raise RateLimited(provider)
+    await asyncio.sleep(wait)
+
+
+def call(provider, fn, deadline=None, timeout=None, retries=MAX_RETRIES):
+    """Runs fn() within provider's quota, retrying rate-limit errors until the deadline."""
+    deadline = _deadline(deadline, timeout)
+    bucket = get_bucket(provider)
+    for attempt in range(retries + 1):
+        acquire(provider, deadline)
+        try:
+            return fn()
+        except Exception as e:
+            if not is_rate_limit_error(e):
+                raise
+            delay = _backoff(attempt, e)
+            bucket.penalize(delay)
+            if attempt == retries or time.monotonic() + delay > deadline:
+                raise RateLimited(provider, f"still rate limited after {attempt + 1} attempts") from e
+            print(f"Scheduler: {provider} rate limited, retrying in {delay:.1f}s")
+
+
+async def call_async(provider, coro_fn, deadline=None, timeout=None, retries=MAX_RETRIES):
+    """Async form of call(); coro_fn is a zero-argument coroutine function."""
+    deadline = _deadline(deadline, timeout)
+    bucket = get_bucket(provider)
+    for attempt in range(retries + 1):
+        await acquire_async(provider, deadline)
+        try:
+            return await coro_fn()
+        except Exception as e:
+            if not is_rate_limit_error(e):
+                raise
+            delay = _backoff(attempt, e)
+            bucket.penalize(delay)
+            if attempt == retries or time.monotonic() + delay > deadline:
+                raise RateLimited(provider, f"still rate limited after {attempt + 1} attempts") from e
+            print(f"Scheduler: {provider} rate limited, retrying in {delay:.1f}s")
+
+
+def _failover_order(options):
+    """Keeps the preferred order, but moves providers with a long queue behind idle ones."""
+    ready = [o for o in options if get_bucket(o[0]).expected_wait() <= FAILOVER_WAIT_SECONDS]
+    busy = [o for o in options if o not in ready]
+    return ready + busy
+
+
+async def call_with_failover_async(options, deadline=None, timeout=None):
+    """
+    options: [(provider, coro_fn), ...] in order of preference.
+    Returns (provider, result) from the first provider that answers.
+    """
+    deadline = _deadline(deadline, timeout)
+    ordered = _failover_order(options)
+    for i, (provider, coro_fn) in enumerate(ordered):
+        last = i == len(ordered) - 1
+        try:
+            # Only the last option may use the whole deadline; others fail fast
+            own_deadline = deadline if last else min(deadline, time.monotonic() + FAILOVER_WAIT_SECONDS)
+            return provider, await call_async(provider, coro_fn, own_deadline, retries=MAX_RETRIES if last else 0)
+        except RateLimited:
+            if last:
+                raise
+            print(f"Scheduler: {provider} saturated, failing over to {ordered[i + 1][0]}")
+
+
+def stats():
+    with _buckets_lock:
+        return {name: {"rpm": round(b.rate * 60, 2), "expected_wait": round(b.expected_wait(), 2)}
+                for name, b in _buckets.items()}
@@ -0,0 +1,205 @@
+"""
+Speech-to-text on Groq Whisper.
+
+Before upload, audio is transcoded with ffmpeg to 16 kHz mono Opus, which
+is what Whisper resamples to anyway and a fraction of the original size.
+If ffmpeg is missing or fails, the original bytes are sent.
+
+The model is picked by language (STT_LANGUAGE, default Malayalam): the
+English-only distil-whisper only serves "en"; everything else goes
+straight to multilingual whisper-large-v3. Each model's health is tracked:
+after STT_FAILURE_THRESHOLD consecutive server errors or timeouts (or one
+"model not found / decommissioned" error) it is skipped for
+STT_MODEL_COOLDOWN_SECONDS. Other 4xx errors mean the audio itself was
+rejected; they don't count against the model and aren't retried.
+Transcripts are cached by a hash of the audio, so a re-sent or forwarded
+voice note is not transcribed twice.
+
+    python stt.py voice.ogg --language ml
+"""
+import argparse
+import asyncio
+import hashlib
+import os
+import shutil
+import subprocess
+import threading
+import time
+
+from dotenv import load_dotenv
+
+import cache
+import scheduler
+
+load_dotenv()
+
+STT_LANGUAGE = os.getenv("STT_LANGUAGE", "ml")
+# Candidates per language, in order of preference; None is every other language
+STT_MODELS = {
+    "en": ["distil-whisper-large-v3-en", "whisper-large-v3-turbo", "whisper-large-v3"],
+    None: ["whisper-large-v3", "whisper-large-v3-turbo"],
+}
+STT_SAMPLE_RATE = 16000
+STT_BITRATE = os.getenv("STT_BITRATE", "24k")
+STT_FAILURE_THRESHOLD = int(os.getenv("STT_FAILURE_THRESHOLD", "2"))
+STT_MODEL_COOLDOWN_SECONDS = float(os.getenv("STT_MODEL_COOLDOWN_SECONDS", "600"))
+TRANSCRIPT_CACHE_SIZE = 256
+TRANSCRIPT_CACHE_TTL = 24 * 3600
+
+_transcripts = cache.TTLCache(maxsize=TRANSCRIPT_CACHE_SIZE, ttl=TRANSCRIPT_CACHE_TTL)
+_flight = cache.SingleFlight()
+_ffmpeg = shutil.which("ffmpeg")
+if not _ffmpeg:
+    print("STT: ffmpeg not found, voice notes are uploaded without transcoding")
+
+
+class ModelHealth:
+    """Consecutive failures per model; a model over the threshold sits out a cooldown."""
+
+    def __init__(self, threshold=STT_FAILURE_THRESHOLD, cooldown=STT_MODEL_COOLDOWN_SECONDS):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._failures = {}    # model -> consecutive failures
+        self._skip_until = {}  # model -> monotonic time it may be tried again
+        self._lock = threading.Lock()
+
+    def succeeded(self, model):
+        with self._lock:
+            self._failures.pop(model, None)
+            if self._skip_until.pop(model, None) is not None:
+                print(f"STT: {model} is healthy again")
+
+    def failed(self, model, permanent=False):
+        with self._lock:
+            failures = self._failures.get(model, 0) + 1
+            self._failures[model] = failures
+            if permanent or failures >= self.threshold:
+                self._skip_until[model] = time.monotonic() + self.cooldown
+                print(f"STT: skipping {model} for {self.cooldown:.0f}s after {failures} failures")
+
+    def order(self, models):
+        """Healthy models first, in preference order; skipped ones last, soonest-back first."""
+        with self._lock:
+            now = time.monotonic()
+            healthy = [m for m in models if self._skip_until.get(m, 0) <= now]
+            sidelined = sorted((m for m in models if m not in healthy), key=lambda m: self._skip_until[m])
+        return healthy, sidelined
+
+
+health = ModelHealth()
+
+
+def models_for(language):
+    return STT_MODELS.get(language, STT_MODELS[None])
+
+
+def is_model_error(e):
+    """Errors that mean the model itself is unusable (retired, unknown, not enabled)."""
+    if getattr(e, "status_code", None) == 404:
+        return True
+    text = str(e).lower()
+    return "decommissioned" in text or "model_not_found" in text or "does not exist" in text
+
+
+def is_model_fault(e):
+    """Model errors, server errors and timeouts: the ones that count against a model's health."""
+    status = getattr(e, "status_code", None)
+    if is_model_error(e) or (status is not None and status >= 500):
+        return True
+    return isinstance(e, (TimeoutError, asyncio.TimeoutError)) or "Timeout" in type(e).__name__
+
+
+def is_input_error(e):
+    """Other 4xx: the audio (corrupt, unsupported, too long) was rejected, whichever model gets it."""
+    status = getattr(e, "status_code", None)
+    return status is not None and 400 <= status < 500 and not is_model_error(e)
+
+
+def transcode(audio_bytes):
+    """
+    Returns (bytes, file name) ready for upload: 16 kHz mono Opus in Ogg, or
+    the input unchanged if ffmpeg is unavailable, fails or doesn't shrink it.
+    """
+    if not _ffmpeg:
+        return audio_bytes, None
+    try:
+        compact = subprocess.run(
+            [_ffmpeg, "-loglevel", "error", "-i", "pipe:0", "-vn", "-ac", "1", "-ar", str(STT_SAMPLE_RATE),
+             "-c:a", "libopus", "-b:a", STT_BITRATE, "-application", "voip", "-f", "ogg", "pipe:1"],
+            input=audio_bytes, capture_output=True, check=True, timeout=60
+        ).stdout
+    except (subprocess.SubprocessError, OSError) as e:
+        print(f"STT: transcode failed, sending original audio: {e}")
+        return audio_bytes, None
+    if not compact or len(compact) >= len(audio_bytes):
+        return audio_bytes, None
+    return compact, "audio.ogg"
+
+
+async def _transcribe(client, audio_bytes, file_name, language):
+    payload, compact_name = await asyncio.to_thread(transcode, audio_bytes)
+    upload_name = compact_name or file_name
+    if payload is not audio_bytes:
+        print(f"STT: {len(audio_bytes) // 1024} KB -> {len(payload) // 1024} KB after transcoding")
+
+    healthy, sidelined = health.order(models_for(language))
+    # If every candidate is sidelined, still try the one due back soonest
+    candidates = healthy or sidelined[:1]
+    last_error = None
+    for model in candidates:
+        try:
+            # Queued under the Groq speech-to-text quota and retried on 429
+            transcription = await scheduler.call_async("groq_stt", lambda: client.audio.transcriptions.create(
+                file=(upload_name, payload),
+                model=model,
+                language=language,
+            ))
+        except scheduler.RateLimited:
+            # Quota, not the model: another model shares the same quota
+            raise
+        except Exception as e:
+            if is_input_error(e):
+                raise
+            print(f"STT: {model} failed: {e}")
+            if is_model_fault(e):
+                health.failed(model, permanent=is_model_error(e))
+            last_error = e
+            continue
+        health.succeeded(model)
+        return transcription.text.strip(), model
+    raise last_error or RuntimeError(f"No speech-to-text model available for '{language}'")
+
+
+async def transcribe_async(client, audio_bytes, file_name="voice.ogg", language=STT_LANGUAGE):
+    """
+    Transcribes audio bytes with an AsyncGroq client. file_name only tells
+    Whisper the container format. Returns the transcript (cached by content).
+    """
+    key = (hashlib.sha256(audio_bytes).hexdigest(), language)
+    text = _transcripts.get(key)
+    if text is not None:
+        return text
+    # The same voice note arriving twice at once is transcribed once
+    (text, model), _ = await _flight.do_async(key, lambda: _transcribe(client, audio_bytes, file_name, language))
+    _transcripts.set(key, text)
+    return text
+
+
+if __name__ == '__main__':
+    from groq import AsyncGroq
+
+    parser = argparse.ArgumentParser(description="Transcribe an audio file the way the bot does.")
+    parser.add_argument('path')
+    parser.add_argument('--language', default=STT_LANGUAGE)
+    args = parser.parse_args()
+
+    with open(args.path, "rb") as f:
+        data = f.read()
+
+    async def main():
+        start = time.perf_counter()
+        text, model = await _transcribe(AsyncGroq(api_key=os.getenv("GROQ_API_KEY")), data,
+                                        os.path.basename(args.path), args.language)
+        print(f"[{model}, {time.perf_counter() - start:.2f}s] {text}")
+
+    asyncio.run(main())
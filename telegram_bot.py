@@ -1,11 +1,14 @@
 
 import os
+import io
+import asyncio
+import hashlib
 import logging
 from telegram import Update
 from telegram.ext import ApplicationBuilder, ContextTypes, MessageHandler, filters
 from dotenv import load_dotenv
 import google.generativeai as genai
-from app import get_ai_response, process_file_monitor  # Reusing logic from app.py
+from app import get_ai_response_async, use_cached_analysis_async  # Reusing logic from app.py
 
 # Setup Logging
 logging.basicConfig(
@@ -22,60 +25,54 @@ if not TOKEN or not API_KEY:
     raise ValueError("Missing TELEGRAM_BOT_TOKEN or GEMINI_API_KEY in .env")
 
 
-from groq import Groq
+from groq import AsyncGroq
+import stt
+import tts
+import upload_queue
+import profiling
 
 # ... (Previous imports)
 
 # Remove or comment out Gemini configure for STT if mostly using Groq now
 # genai.configure(api_key=API_KEY) # We might keep gemini for file upload summarizing in app.py, but here we use Groq
 
-async def transcribe_audio(file_path):
-    client = Groq(api_key=os.getenv("GROQ_API_KEY"))
-    
+_groq_client = None
+
+def get_groq_client():
+    # Created lazily so it binds to the bot's running event loop
+    global _groq_client
+    if _groq_client is None:
+        _groq_client = AsyncGroq(api_key=os.getenv("GROQ_API_KEY"))
+    return _groq_client
+
+@profiling.profiled("transcribe_audio")
+async def transcribe_audio(audio_bytes, file_name="voice.ogg"):
+    """Transcribes an in-memory voice note (see stt.py for model routing and caching)."""
     try:
-        print(f"Uploading {file_path} to Groq Whisper...")
-        with open(file_path, "rb") as file:
-            transcription = client.audio.transcriptions.create(
-                file=(file_path, file.read()),
-                model="distil-whisper-large-v3-en",
-                # prompt="The language is Malayalam.", # Optional, but distil-whisper is mainly English focused. 
-                # Groq has "whisper-large-v3" which is multi-lingual.
-                # Let's use whisper-large-v3 for Malayalam support.
-            )
-            return transcription.text.strip()
-            
+        return await stt.transcribe_async(get_groq_client(), audio_bytes, file_name)
     except Exception as e:
-        print(f"Groq Whisper Error: {e}")
-        # Build logic here or just fail. 
-        # Groq Whisper "on-demand" might fail if model not correct.
-        # Retry with "whisper-large-v3"
-        try: 
-            with open(file_path, "rb") as file:
-                transcription = client.audio.transcriptions.create(
-                  file=(file_path, file.read()),
-                  model="whisper-large-v3"
-                )
-            return transcription.text.strip()
-        except Exception as e2:
-            logging.error(f"Whisper Backup Error: {e2}")
-            return None
+        logging.error(f"Groq Whisper Error: {e}")
+        return None
 
 
+# One trace per voice note: download, transcription, reply and TTS as stages
+@profiling.profiled("telegram_voice")
 async def voice_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
     logging.info(f"Received voice from {user.first_name}")
 
-    # 1. Download Voice File
+    # 1. Download Voice File (.ogg, Telegram default) into memory: the whole
+    # turn stays in buffers, so concurrent voice notes never share files
     voice_file = await update.message.voice.get_file()
-    # Save as .ogg (Telegram default)
-    file_path = f"temp_voice_{user.id}.ogg"
-    await voice_file.download_to_drive(file_path)
+    voice_buffer = io.BytesIO()
+    with profiling.span("download"):
+        await voice_file.download_to_memory(voice_buffer)
     
     try:
         await update.message.reply_text("🎤 Listening and processing...")
 
         # 2. Transcribe
-        transcribed_text = await transcribe_audio(file_path)
+        transcribed_text = await transcribe_audio(voice_buffer.getvalue())
         
         if not transcribed_text:
             await update.message.reply_text("Sorry, I couldn't understand that.")
@@ -85,36 +82,33 @@ async def voice_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(f"🗣 You said: {transcribed_text}")
 
         # 3. Get AI Response (using app.py logic)
-        # Note: get_ai_response is synchronous, so we run it directly (blocking is fine for low volume/demo)
-        result, error = get_ai_response(transcribed_text)
+        # Awaited on the bot's loop, so other chats keep being served meanwhile
+        # The reply is synthesized here, straight into memory, so skip the pipeline's TTS
+        result, error = await get_ai_response_async(transcribed_text, f"tg:{user.id}", with_audio=False)
         
         if error:
             await update.message.reply_text(f"Error: {error}")
             return
             
         ai_text = result['response']
-        audio_web_path = result['audio_url'] # e.g., /static/response_xyz.mp3
+        # 4. Synthesize the reply into a buffer (gTTS is blocking, so off the loop)
+        audio = None
+        try:
+            with profiling.span("tts"):
+                audio = await asyncio.to_thread(tts.render, ai_text)
+        except Exception as e:
+            logging.error(f"TTS Error: {e}")
         
-        # 4. Convert web path to local system path
-        # Remove leading slash if present
-        if audio_web_path.startswith('/'):
-            audio_web_path = audio_web_path[1:]
-            
-        local_audio_path = os.path.join(os.getcwd(), audio_web_path)
-        
-        # 5. Send Voice Reply
-        if os.path.exists(local_audio_path):
-            await update.message.reply_voice(voice=open(local_audio_path, 'rb'), caption=ai_text)
+        # 5. Send Voice Reply from memory
+        if audio:
+            with profiling.span("send_reply"):
+                await update.message.reply_voice(voice=io.BytesIO(audio), caption=ai_text)
         else:
             await update.message.reply_text(f"Response: {ai_text} (Audio generation failed)")
 
     except Exception as e:
         logging.error(f"Handler Error: {e}")
         await update.message.reply_text("Something went wrong.")
-    finally:
-        # Cleanup temp upload
-        if os.path.exists(file_path):
-            os.remove(file_path)
 
 
 async def file_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -138,17 +132,28 @@ async def file_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         await update.message.reply_text("📥 Downloading and analyzing...")
 
-        # Ensure filename is safe (basic)
-        local_path = os.path.join("uploads", file_name)
-        os.makedirs("uploads", exist_ok=True)
-        
-        # Download
-        await file_obj.download_to_drive(local_path)
-        
-        # Process (OCR/Analysis) - Reusing app.py logic
-        # Note: We run this synchronously for now, or could offload to thread if needed
-        # process_file_monitor deals with context updates
-        extracted_text, error = process_file_monitor(local_path)
+        # Download into memory and hash it: a circular we've already analyzed
+        # is learned from the OCR cache without touching uploads/
+        data = bytes(await file_obj.download_as_bytearray())
+        source_hash = hashlib.sha256(data).hexdigest()
+        extracted_text = await use_cached_analysis_async(source_hash, file_name)
+        error = None
+        local_path = None
+
+        if extracted_text is None:
+            # Ensure filename is safe (basic)
+            local_path = os.path.join("uploads", f"{source_hash[:12]}_{os.path.basename(file_name)}")
+            os.makedirs("uploads", exist_ok=True)
+            with open(local_path, "wb") as f:
+                f.write(data)
+            
+            # Process (OCR/Analysis) on the same upload queue the web app uses
+            job_id = upload_queue.enqueue(local_path, source_hash, origin='telegram')
+            job = await upload_queue.wait_async(job_id)
+            if job is None:
+                extracted_text, error = None, "The analysis job was lost; please send the file again."
+            else:
+                extracted_text, error = job['extracted_text'], job['error']
         
         if error:
             await update.message.reply_text(f"❌ Analysis Failed: {error}")
@@ -160,7 +165,7 @@ async def file_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Cleanup handled by process_file_monitor (delete prompt file) 
         # but we also have the local downloaded file.
         # Let's clean it up to save space.
-        if os.path.exists(local_path):
+        if local_path and os.path.exists(local_path):
             os.remove(local_path)
 
     except Exception as e:
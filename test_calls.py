@@ -0,0 +1,39 @@
+"""
+Voice call turn state (calls table).
+
+    python -m pytest test_calls.py
+"""
+import pytest
+
+import database
+
+CALL_SID = "CA123"
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_NAME", str(tmp_path / "conversations.db"))
+    database.close_all()
+    database.init_db()
+    yield
+    database.close_all()
+
+
+def test_late_finish_of_timed_out_turn_is_ignored(db):
+    database.start_call(CALL_SID, "+15550001")
+    first = database.begin_call_turn(CALL_SID)
+    assert database.begin_call_turn(CALL_SID) is None
+
+    # The poll gives up on the first turn and the caller speaks again
+    assert database.finish_call_turn(CALL_SID, first, "timeout", failed=True)
+    assert database.take_call_reply(CALL_SID)['reply_text'] == "timeout"
+    second = database.begin_call_turn(CALL_SID)
+    assert second == first + 1
+
+    # The first turn's worker finishes late: its answer must not reach the caller
+    assert not database.finish_call_turn(CALL_SID, first, "stale answer")
+    assert database.get_call(CALL_SID)['state'] == 'thinking'
+    assert database.take_call_reply(CALL_SID) is None
+
+    assert database.finish_call_turn(CALL_SID, second, "fresh answer")
+    assert database.take_call_reply(CALL_SID)['reply_text'] == "fresh answer"
@@ -0,0 +1,81 @@
+"""
+Prompt budgeting over a long Malayalam session.
+
+    python -m pytest test_prompt.py
+"""
+import app
+import database
+import prompt
+
+SESSION = "tg:1"
+IDENTITY = "ഞാൻ അനുവിന്റെ അമ്മയാണ്, ഏഴാം ക്ലാസിലെ അനു."
+CHILD = "അനുവിന്റെ കണക്ക് മാർക്കിനെക്കുറിച്ച് അറിയണം."
+
+
+def malayalam_turn(i):
+    return (f"മോളുടെ പഠനത്തെക്കുറിച്ച് ഒരു ചോദ്യം കൂടി ചോദിക്കട്ടെ, ടീച്ചർ എന്ത് പറഞ്ഞു എന്ന് അറിയണം ({'ഒന്ന്' * (i % 3 + 1)})",
+            "ശരി, അനു ക്ലാസിൽ നന്നായി ശ്രദ്ധിക്കുന്നുണ്ട്. വീട്ടിൽ കുറച്ച് കൂടി പരിശീലനം നല്ലതാണ്. " * 2)
+
+
+class FakeModel:
+    def start_chat(self, history):
+        return None
+
+
+def run_session(tmp_path, monkeypatch, turns):
+    """
+    Replays a session through app.prepare_turn/finish_turn with Gemini stubbed out.
+    Returns the last PreparedTurn and the stored summary.
+    """
+    monkeypatch.setattr(database, "DB_NAME", str(tmp_path / "conversations.db"))
+    monkeypatch.setattr(app.llm, "get_model", lambda system_prompt: FakeModel())
+    database.close_all()
+    database.init_db()
+    turn = None
+    try:
+        for user_text, ai_response in turns:
+            turn = app.prepare_turn(user_text, SESSION)
+            app.finish_turn(ai_response, user_text, SESSION, turn.student_id, turn.prompt_tokens)
+        summary, _ = database.get_session_summary(SESSION)
+    finally:
+        database.close_all()
+    return turn, summary
+
+
+def test_identity_survives_long_session(tmp_path, monkeypatch):
+    turns = [(IDENTITY, "നമസ്കാരം, അനുവിന്റെ അമ്മേ."), (CHILD, "അനുവിന് കണക്കിൽ 78 മാർക്കുണ്ട്.")]
+    turns += [malayalam_turn(i) for i in range(120)]
+    turn, summary = run_session(tmp_path, monkeypatch, turns)
+
+    assert IDENTITY in summary
+    assert "അനുവിന്റെ കണക്ക്" in summary
+    assert summary in turn.message
+    assert prompt.estimate_tokens(summary) <= prompt.SUMMARY_TOKEN_BUDGET
+    total = (prompt.estimate_tokens(turn.system_prompt) + prompt.estimate_tokens(summary)
+             + sum(prompt.turn_tokens(u, a) for u, a in turn.history))
+    assert total <= prompt.PROMPT_TOKEN_BUDGET
+
+
+def test_turns_outside_read_window_are_folded(tmp_path, monkeypatch):
+    # Short turns: far more than HISTORY_MAX_TURNS fit the budget
+    count = prompt.HISTORY_MAX_TURNS + 10
+    turns = [(IDENTITY, "ശരി.")] + [(f"ചോദ്യം {i}", "ശരി.") for i in range(count)]
+    turn, summary = run_session(tmp_path, monkeypatch, turns)
+
+    assert len(turn.history) == prompt.HISTORY_MAX_TURNS
+    assert IDENTITY in summary
+    # Every earlier turn is either in the prompt or in the summary (the last one is the new message)
+    for i in range(count - 1):
+        user_text = f"ചോദ്യം {i}"
+        assert f"Parent: {user_text} |" in summary or any(u == user_text for u, _ in turn.history)
+
+
+def test_middle_lines_are_compressed_before_dropping():
+    turns = [(1, IDENTITY, "ശരി.")] + [(i, malayalam_turn(i)[0], malayalam_turn(i)[1]) for i in range(2, 40)]
+    summary = prompt.fold_into_summary("", turns)
+    lines = summary.split("\n")
+
+    assert lines[0].startswith(prompt.PINNED) and IDENTITY in lines[0]
+    # The newest line is still at full width; older ones were shortened first
+    assert len(lines[-1]) > len(lines[2])
+    assert prompt.estimate_tokens(summary) <= prompt.SUMMARY_TOKEN_BUDGET
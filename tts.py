@@ -0,0 +1,320 @@
+"""
+Content-addressed text-to-speech cache.
+
+Each clip is stored once under a hash of (lang, text) in static/tts, so
+identical phrases (the greeting, common replies) are synthesized once and
+their URLs never change: /audio/<hash>.mp3 can be cached forever by
+browsers and Twilio. Files are written to a temp name and renamed into
+place, so a reader never sees a half-written clip. The directory is kept
+under TTS_CACHE_MAX_MB by evicting the least recently used clips.
+
+Long texts are split at sentence boundaries and the chunks synthesized
+concurrently on a bounded pool, then their MP3 frames are joined in order.
+The engine is pluggable (TTS_BACKEND): "gtts" (default, online) or
+"espeak" (offline, espeak-ng + ffmpeg). Compare them with:
+    python tts.py bench --backend gtts espeak
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+from gtts import gTTS
+
+import cache
+
+load_dotenv()
+
+TTS_DIR = os.path.join('static', 'tts')
+TTS_LANG = 'ml'
+TTS_CACHE_MAX_BYTES = int(float(os.getenv("TTS_CACHE_MAX_MB", "200")) * 1024 * 1024)
+# Eviction trims down to this fraction of the limit, so it doesn't run on every write
+EVICT_TO_FRACTION = 0.9
+URL_PREFIX = "/audio/"
+# Texts longer than this are synthesized as parallel chunks
+CHUNK_CHARS = int(os.getenv("TTS_CHUNK_CHARS", "200"))
+CHUNK_WORKERS = int(os.getenv("TTS_CHUNK_WORKERS", "4"))
+SENTENCE_END = re.compile(r'(?<=[.!?।])\s+|\n+')
+
+os.makedirs(TTS_DIR, exist_ok=True)
+
+
+
+class GTTSBackend:
+    """Google Translate TTS: good Malayalam, needs the network."""
+    name = "gtts"
+
+    def synthesize(self, text, lang):
+        buf = io.BytesIO()
+        gTTS(text=text, lang=lang).write_to_fp(buf)
+        return buf.getvalue()
+
+
+class EspeakBackend:
+    """Offline espeak-ng voice, encoded to MP3 with ffmpeg so clips stay joinable."""
+    name = "espeak"
+
+    def __init__(self):
+        self.espeak = shutil.which("espeak-ng") or shutil.which("espeak")
+        self.ffmpeg = shutil.which("ffmpeg")
+        if not self.espeak or not self.ffmpeg:
+            raise RuntimeError("espeak backend needs espeak-ng and ffmpeg on PATH")
+
+    def synthesize(self, text, lang):
+        wav = subprocess.run([self.espeak, "-v", lang, "--stdout", text],
+                             capture_output=True, check=True).stdout
+        return subprocess.run([self.ffmpeg, "-loglevel", "error", "-i", "pipe:0", "-f", "mp3", "pipe:1"],
+                              input=wav, capture_output=True, check=True).stdout
+
+
+BACKENDS = {"gtts": GTTSBackend, "espeak": EspeakBackend}
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend(name=None):
+    name = name or os.getenv("TTS_BACKEND", "gtts")
+    with _backends_lock:
+        if name not in _backends:
+            if name not in BACKENDS:
+                raise ValueError(f"Unknown TTS backend: {name}")
+            _backends[name] = BACKENDS[name]()
+        return _backends[name]
+
+
+_flight = cache.SingleFlight()
+_chunk_pool = ThreadPoolExecutor(max_workers=CHUNK_WORKERS, thread_name_prefix="tts-chunk")
+_usage_lock = threading.Lock()
+_usage_bytes = None  # total size of TTS_DIR, computed on first write
+
+
+def audio_name(text, lang=TTS_LANG, backend="gtts"):
+    key = f"{lang}\0{text}" if backend == "gtts" else f"{backend}\0{lang}\0{text}"
+    digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+    return f"{digest[:32]}.mp3"
+
+
+def audio_path(name):
+    return os.path.join(TTS_DIR, name)
+
+
+def audio_url(name):
+    return URL_PREFIX + name
+
+
+def local_path(url):
+    """Maps an /audio/<name> URL back to the file on disk (None for other URLs)."""
+    if not url or not url.startswith(URL_PREFIX):
+        return None
+    return audio_path(os.path.basename(url))
+
+
+def _scan():
+    """Returns [(mtime, size, path)] for every cached clip."""
+    entries = []
+    for entry in os.scandir(TTS_DIR):
+        if entry.name.endswith('.mp3'):
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+    return entries
+
+
+def _account(path):
+    """Adds a new clip to the running total and evicts others if over the limit."""
+    global _usage_bytes
+    with _usage_lock:
+        if _usage_bytes is None:
+            _usage_bytes = sum(size for _, size, _ in _scan())
+        else:
+            _usage_bytes += os.path.getsize(path)
+        if _usage_bytes <= TTS_CACHE_MAX_BYTES:
+            return
+        # Least recently used first: hits refresh a clip's mtime
+        entries = sorted(_scan())
+        total = sum(size for _, size, _ in entries)
+        target = TTS_CACHE_MAX_BYTES * EVICT_TO_FRACTION
+        evicted = 0
+        for _, size, old_path in entries:
+            if total <= target:
+                break
+            if old_path == path:
+                continue
+            try:
+                os.remove(old_path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted += 1
+        _usage_bytes = total
+    print(f"TTS cache: evicted {evicted} clips, {total // 1024} KB kept")
+
+
+def split_chunks(text, max_chars=CHUNK_CHARS):
+    """Groups whole sentences into chunks of up to max_chars (a longer sentence is its own chunk)."""
+    chunks = []
+    current = ""
+    for sentence in SENTENCE_END.split(text.strip()):
+        if not sentence:
+            continue
+        if current and len(current) + 1 + len(sentence) > max_chars:
+            chunks.append(current)
+            current = sentence
+        else:
+            current = f"{current} {sentence}" if current else sentence
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _strip_id3(data):
+    """Drops a leading ID3v2 tag so joined clips are a clean run of MP3 frames."""
+    if len(data) > 10 and data[:3] == b"ID3":
+        size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+        return data[10 + size:]
+    return data
+
+
+def render(text, lang=TTS_LANG, backend=None, parallel=True):
+    """Returns MP3 bytes for text, synthesizing sentence chunks concurrently."""
+    backend = backend or get_backend()
+    chunks = split_chunks(text)
+    if len(chunks) <= 1 or not parallel:
+        return backend.synthesize(text, lang)
+    # map() yields in submission order, so the audio stays in sentence order
+    parts = _chunk_pool.map(lambda chunk: backend.synthesize(chunk, lang), chunks)
+    return b"".join(_strip_id3(part) for part in parts)
+
+
+def _write(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=TTS_DIR, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    _account(path)
+
+
+def _synthesize(text, lang, path, backend):
+    _write(path, render(text, lang, backend))
+
+
+def synthesize(text, lang=TTS_LANG, backend=None):
+    """Returns the URL of the clip for text, synthesizing it only on a cache miss."""
+    backend = backend or get_backend()
+    name = audio_name(text, lang, backend.name)
+    path = audio_path(name)
+    try:
+        # Hit: bump mtime so LRU eviction keeps it
+        os.utime(path)
+        return audio_url(name)
+    except FileNotFoundError:
+        pass
+    # Concurrent requests for the same clip share one synthesis
+    _flight.do(name, lambda: _synthesize(text, lang, path, backend))
+    return audio_url(name)
+
+
+def join(urls, text, lang=TTS_LANG, backend=None):
+    """
+    Returns the URL of one clip for text made by joining already cached
+    clips of its parts (a streamed reply's sentences) in order, without
+    synthesizing anything. None if a part is missing.
+    """
+    backend = backend or get_backend()
+    name = audio_name(text, lang, backend.name)
+    path = audio_path(name)
+    try:
+        os.utime(path)
+        return audio_url(name)
+    except FileNotFoundError:
+        pass
+    parts = []
+    for url in urls:
+        part_path = local_path(url)
+        if part_path is None:
+            return None
+        try:
+            with open(part_path, 'rb') as f:
+                parts.append(_strip_id3(f.read()))
+        except FileNotFoundError:
+            return None
+    _write(path, b"".join(parts))
+    return audio_url(name)
+
+
+def prewarm(phrases, lang=TTS_LANG):
+    """Synthesizes fixed phrases ahead of time; failures are only logged."""
+    for text in phrases:
+        try:
+            synthesize(text, lang)
+        except Exception as e:
+            print(f"TTS prewarm failed for {text[:30]!r}: {e}")
+
+
+def stats():
+    entries = _scan()
+    return {"clips": len(entries), "bytes": sum(size for _, size, _ in entries),
+            "max_bytes": TTS_CACHE_MAX_BYTES}
+
+
+def benchmark(text, backend_names, runs=3, lang=TTS_LANG):
+    """Times sequential vs chunked synthesis of text for each backend (bypasses the cache)."""
+    results = {}
+    for name in backend_names:
+        backend = get_backend(name)
+        for parallel in (False, True):
+            timings = []
+            size = 0
+            for _ in range(runs):
+                start = time.perf_counter()
+                size = len(render(text, lang, backend, parallel=parallel))
+                timings.append(time.perf_counter() - start)
+            results[f"{name}/{'chunked' if parallel else 'sequential'}"] = {
+                "best_s": round(min(timings), 3), "avg_s": round(sum(timings) / runs, 3), "bytes": size
+            }
+    return results
+
+
+BENCH_TEXT = (
+    "നാളെ രാവിലെ പത്ത് മണിക്ക് രക്ഷാകർതൃ യോഗം നടക്കും. "
+    "കുട്ടിയുടെ ഈ ടേമിലെ മാർക്കുകൾ യോഗത്തിൽ ചർച്ച ചെയ്യും. "
+    "ഗണിതത്തിൽ കൂടുതൽ ശ്രദ്ധ ആവശ്യമാണ്. "
+    "ഹാജർ നില തൃപ്തികരമാണ്. "
+    "ദയവായി സമയത്ത് എത്തിച്ചേരുക. "
+    "നിങ്ങൾ പങ്കെടുക്കുമോ എന്ന് അറിയിക്കുക."
+)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Text-to-speech cache tools.")
+    sub = parser.add_subparsers(dest='command', required=True)
+    bench_cmd = sub.add_parser('bench', help="Compare backends, sequential vs chunked")
+    bench_cmd.add_argument('--backend', nargs='+', default=["gtts"], choices=sorted(BACKENDS))
+    bench_cmd.add_argument('--runs', type=int, default=3)
+    bench_cmd.add_argument('--text', default=BENCH_TEXT)
+    sub.add_parser('stats', help="Print cache size")
+    args = parser.parse_args()
+
+    if args.command == 'bench':
+        for label, result in benchmark(args.text, args.backend, args.runs).items():
+            print(f"{label:20} best {result['best_s']:.3f}s  avg {result['avg_s']:.3f}s  {result['bytes']} bytes")
+    else:
+        print(json.dumps(stats(), indent=2))
@@ -0,0 +1,172 @@
+"""
+Background queue for document analysis.
+
+/upload and the Telegram bot save the file, enqueue a job and return at
+once; a bounded pool (UPLOAD_WORKERS) runs the vision pipeline. Jobs live
+in the upload_jobs table, so anything queued (or interrupted mid-run) when
+the process stops is picked up again by start(). A sweeper thread also
+re-queues jobs left 'processing' by a worker that died mid-run.
+
+Job status: queued -> processing -> done | error
+"""
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+import database
+
+load_dotenv()
+
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "2"))
+# A job still 'processing' after this long was orphaned by a dead process
+STALE_JOB_SECONDS = 900
+# How often the sweeper looks for orphaned jobs
+SWEEP_SECONDS = 60
+# Finished jobs are kept this long for status lookups
+JOB_RETENTION_DAYS = 7
+
+JOB_COLUMNS = ('id', 'filepath', 'source_hash', 'class_scope', 'origin', 'status',
+               'progress', 'extracted_text', 'error', 'created_at', 'updated_at')
+
+_executor = None
+_process = None
+_start_lock = threading.Lock()
+
+
+def start(process_fn):
+    """
+    Starts the worker pool and the stale-job sweeper once per process.
+    process_fn(filepath, class_scope, source_hash, on_progress) returns
+    (extracted_text, error_message). Resumes everything still queued.
+    """
+    global _executor, _process
+    with _start_lock:
+        if _executor is not None:
+            return
+        _process = process_fn
+        _executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix="upload")
+    _requeue_stale()
+    pending = [row[0] for row in database.get_connection().execute(
+        "SELECT id FROM upload_jobs WHERE status = 'queued' ORDER BY id"
+    ).fetchall()]
+    if pending:
+        print(f"Upload queue: resuming {len(pending)} jobs")
+    for job_id in pending:
+        _executor.submit(_run, job_id)
+    threading.Thread(target=_sweep, name="upload-sweeper", daemon=True).start()
+
+
+def _requeue_stale():
+    """Moves jobs stuck in 'processing' past STALE_JOB_SECONDS back to 'queued'. Returns their ids."""
+    with database.transaction() as c:
+        c.execute('''
+            SELECT id FROM upload_jobs WHERE status = 'processing' AND updated_at < datetime('now', ?)
+        ''', (f'-{STALE_JOB_SECONDS} seconds',))
+        stale = [row[0] for row in c.fetchall()]
+        c.executemany('''
+            UPDATE upload_jobs SET status = 'queued', progress = NULL, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND status = 'processing'
+        ''', [(job_id,) for job_id in stale])
+    return stale
+
+
+def _sweep():
+    while True:
+        time.sleep(SWEEP_SECONDS)
+        try:
+            stale = _requeue_stale()
+            if stale:
+                print(f"Upload queue: re-queued {len(stale)} stale jobs")
+            for job_id in stale:
+                _executor.submit(_run, job_id)
+        except Exception as e:
+            print(f"Upload queue sweep failed: {e}")
+        finally:
+            database.release_connection()
+
+
+def enqueue(filepath, source_hash=None, class_scope=None, origin='web'):
+    """Queues a saved file for analysis and returns the job id."""
+    with database.transaction() as c:
+        c.execute('''
+            INSERT INTO upload_jobs (filepath, source_hash, class_scope, origin) VALUES (?, ?, ?, ?)
+        ''', (filepath, source_hash, class_scope, origin))
+        job_id = c.lastrowid
+    _executor.submit(_run, job_id)
+    return job_id
+
+
+def _update(job_id, **fields):
+    assignments = ", ".join(f"{name} = ?" for name in fields)
+    with database.transaction() as c:
+        c.execute(f'''
+            UPDATE upload_jobs SET {assignments}, updated_at = CURRENT_TIMESTAMP WHERE id = ?
+        ''', (*fields.values(), job_id))
+
+
+def _claim(job_id):
+    """
+    Moves a queued job to processing and returns (filepath, class_scope, source_hash),
+    or None if another worker or process got it first.
+    """
+    with database.transaction() as c:
+        c.execute('''
+            UPDATE upload_jobs SET status = 'processing', updated_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND status = 'queued'
+        ''', (job_id,))
+        if not c.rowcount:
+            return None
+        c.execute('SELECT filepath, class_scope, source_hash FROM upload_jobs WHERE id = ?', (job_id,))
+        return c.fetchone()
+
+
+def _run(job_id):
+    try:
+        claimed = _claim(job_id)
+        if not claimed:
+            return
+        filepath, class_scope, source_hash = claimed
+
+        def on_progress(done, total):
+            _update(job_id, progress=f"{done}/{total} pages")
+
+        extracted_text, error = _process(filepath, class_scope, source_hash, on_progress)
+        if error:
+            print(f"Upload job {job_id} failed: {error}")
+            _update(job_id, status='error', error=str(error))
+        else:
+            _update(job_id, status='done', extracted_text=extracted_text)
+    except Exception as e:
+        print(f"Upload job {job_id} failed: {e}")
+        _update(job_id, status='error', error=f"Analysis Error: {str(e)}")
+    finally:
+        database.release_connection()
+
+
+def get_job(job_id):
+    row = database.get_connection().execute(
+        f'SELECT {", ".join(JOB_COLUMNS)} FROM upload_jobs WHERE id = ?', (job_id,)
+    ).fetchone()
+    return dict(zip(JOB_COLUMNS, row)) if row else None
+
+
+async def wait_async(job_id, poll_seconds=1.0):
+    """Waits for a job to finish (for the Telegram bot) and returns it."""
+    while True:
+        job = await asyncio.to_thread(get_job, job_id)
+        if job is None or job['status'] in ('done', 'error'):
+            return job
+        await asyncio.sleep(poll_seconds)
+
+
+def prune_jobs(older_than_days=JOB_RETENTION_DAYS):
+    """Drops finished jobs older than older_than_days. Returns the number removed."""
+    with database.transaction() as c:
+        c.execute('''
+            DELETE FROM upload_jobs WHERE status IN ('done', 'error') AND updated_at < datetime('now', ?)
+        ''', (f'-{int(older_than_days)} days',))
+        return c.rowcount